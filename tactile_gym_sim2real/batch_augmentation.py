@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import cv2
+
+
+def _default_rng():
+    ''' Generator seeded from the global numpy state, so results follow
+        np.random.seed and differ between DataLoader workers (which torch
+        reseeds) while still allowing fast float32 sampling.
+    '''
+    return np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+
+
+def _value_scale(dtype):
+    ''' Full scale intensity of an image dtype, matching skimage conventions
+        (uint8 images are 0-255, float images 0-1).
+    '''
+    return 255.0 if dtype == np.uint8 else 1.0
+
+
+class NoiseBank():
+    ''' Pre-generated bank of float32 standard normal noise images. Sampling
+        picks a random bank entry with random flips, giving size * 4 distinct
+        noise patterns without drawing any new random normals.
+    '''
+
+    def __init__(self, shape, size=64, seed=None):
+        rng = np.random.default_rng(seed) if seed is not None else _default_rng()
+        self.shape = tuple(shape)
+        self.bank = rng.standard_normal((size, *self.shape), dtype=np.float32)
+
+    def sample(self):
+        ''' Returns a read only view of one noise image.
+        '''
+        i = np.random.randint(len(self.bank))
+        flip_y, flip_x = np.random.randint(2, size=2) * 2 - 1
+        return self.bank[i, ::flip_y, ::flip_x]
+
+
+def random_images_brightness(images, brightlims, out=None):
+    ''' Random contrast (alpha) and brightness (beta) per image for a stack of
+        (N,H,W,C) uint8 images. Each image is remapped through a 256 entry
+        lookup table of clip(alpha*x + beta), so the result is identical to
+        image_transforms.random_image_brightness for the same alpha and beta.
+    '''
+    if images.dtype != np.uint8:
+        raise ValueError('This random brightness should only be applied to uint8 images on a 0-255 scale')
+
+    a1, a2, b1, b2 = brightlims
+    n = len(images)
+    alphas = np.random.uniform(a1, a2, n)
+    betas = np.random.randint(b1, b2, n)
+
+    values = np.arange(256, dtype=np.float64)
+    luts = np.clip(alphas[:, np.newaxis] * values + betas[:, np.newaxis], 0, 255).astype(np.uint8)
+
+    if out is None:
+        out = np.empty_like(images)
+    for i in range(n):
+        cv2.LUT(images[i], luts[i], dst=out[i])
+    return out
+
+
+def random_images_noise(images, noise_var, bank=None, out=None):
+    ''' Adds clipped gaussian noise with variance noise_var (on the 0-1 scale
+        used by skimage.util.random_noise) to a stack of (N,H,W,C) images.
+        Output keeps the input dtype, uint8 images stay on a 0-255 scale.
+        Noise is drawn in float32, or taken from a NoiseBank if given.
+    '''
+    scale = _value_scale(images.dtype)
+    std = np.float32(np.sqrt(noise_var) * scale)
+
+    if out is None:
+        out = np.empty_like(images)
+
+    rng = _default_rng() if bank is None else None
+    work = np.empty(images.shape[1:], dtype=np.float32)
+    for i in range(len(images)):
+        noise = bank.sample() if bank is not None else rng.standard_normal(work.shape, dtype=np.float32)
+        np.multiply(noise, std, out=work)
+        np.add(work, images[i], out=work)
+        np.clip(work, 0, scale, out=work)
+        if images.dtype == np.uint8:
+            np.rint(work, out=work)
+        out[i] = work
+    return out
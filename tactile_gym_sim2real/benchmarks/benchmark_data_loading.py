@@ -0,0 +1,186 @@
+'''
+Benchmarks the pix2pix training data loaders on a synthetic real/sim dataset:
+torch DataLoader worker processes against the ThreadedDataLoader thread pool,
+with the DataGenerator settings used by pix2pix.py.
+
+Reports time to the first batch, steady state throughput over an epoch and
+the peak resident memory of the training process and its loader workers, and
+writes the results as json so runs can be compared, e.g.
+    python -m tactile_gym_sim2real.benchmarks.benchmark_data_loading --workers 2 4 8 --output results.json
+    python -m tactile_gym_sim2real.benchmarks.benchmark_data_loading --loaders thread --batched_loading true
+'''
+
+import os
+import json
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import cv2
+import torch
+
+from tactile_gym.utils.general_utils import str2bool
+from tactile_gym_sim2real.image_transforms import process_image
+from tactile_gym_sim2real.pix2pix.image_generator import DataGenerator, collate_batch
+from tactile_gym_sim2real.pix2pix.threaded_loader import ThreadedDataLoader
+from tactile_gym_sim2real.benchmarks.benchmark_image_transforms import environment_info
+from tactile_gym_sim2real.benchmarks.fused_resize_report import synthetic_tactile_image
+
+bbox = [80, 25, 530, 475]
+
+
+def make_dataset(data_dir, n_images, dims, seed=0):
+    ''' Raw 640x480 real images and processed sim images at dims, laid out as
+        the collected csv_train dirs.
+    '''
+    rng = np.random.default_rng(seed)
+    real_dir, sim_dir = os.path.join(data_dir, 'real'), os.path.join(data_dir, 'sim')
+    os.makedirs(os.path.join(real_dir, 'images'))
+    os.makedirs(os.path.join(sim_dir, 'images'))
+
+    sensor_images = ['image_{}.png'.format(i + 1) for i in range(n_images)]
+    for sensor_image in sensor_images:
+        image = synthetic_tactile_image(rng)
+        cv2.imwrite(os.path.join(real_dir, 'images', sensor_image), image)
+        cv2.imwrite(os.path.join(sim_dir, 'images', sensor_image),
+                    process_image(image, gray=True, bbox=bbox, dims=dims, thresh=True))
+
+    targets_df = pd.DataFrame({'sensor_image': sensor_images})
+    targets_df.to_csv(os.path.join(real_dir, 'targets.csv'), index=False)
+    targets_df.to_csv(os.path.join(sim_dir, 'targets.csv'), index=False)
+    return real_dir, sim_dir
+
+
+def process_tree_rss_mb(pid):
+    ''' Resident memory of a process and all of its children, linux only.
+    '''
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS'))
+        children = []
+        for children_file in glob.glob('/proc/{}/task/*/children'.format(pid)):
+            with open(children_file) as f:
+                children += f.read().split()
+    except (OSError, StopIteration):
+        return 0.0
+
+    return rss_kb / 1024.0 + sum(process_tree_rss_mb(child) for child in children)
+
+
+class PeakMemory():
+    ''' Samples the process tree memory on a background thread.
+    '''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, process_tree_rss_mb(os.getpid()))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def make_loader(loader, n_workers, generator, opt):
+    if loader == 'thread':
+        return ThreadedDataLoader(generator, batch_size=opt.batch_size, shuffle=True,
+                                  n_threads=n_workers, prefetch=opt.prefetch_batches)
+
+    return torch.utils.data.DataLoader(generator, batch_size=opt.batch_size, shuffle=True,
+                                       num_workers=n_workers,
+                                       prefetch_factor=opt.prefetch_batches if n_workers > 0 else None,
+                                       collate_fn=collate_batch)
+
+
+def benchmark_loader(loader, n_workers, generator, opt):
+    ''' Time to first batch and throughput over the remaining batches, for
+        each epoch. Each epoch starts a fresh iterator, so the process loader
+        pays its worker start up every epoch as in training.
+    '''
+    data_loader = make_loader(loader, n_workers, generator, opt)
+
+    first_batch_s, epoch_samples_per_s = [], []
+    with PeakMemory() as peak_memory:
+        for epoch in range(opt.n_epochs):
+            start = time.perf_counter()
+            n_samples = 0
+            for i, batch in enumerate(data_loader):
+                if i == 0:
+                    first_batch_time = time.perf_counter()
+                    first_batch_s.append(first_batch_time - start)
+                else:
+                    n_samples += len(batch['real'])
+            epoch_samples_per_s.append(n_samples / max(time.perf_counter() - first_batch_time, 1e-9))
+
+    if loader == 'thread':
+        data_loader.close()
+
+    return {
+        'loader': loader,
+        'n_workers': n_workers,
+        'first_batch_s': float(np.mean(first_batch_s)),
+        'samples_per_s': float(np.mean(epoch_samples_per_s)),
+        'peak_rss_mb': float(peak_memory.peak_mb),
+    }
+
+
+def main(opt):
+
+    dims = (opt.size, opt.size)
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        real_dir, sim_dir = make_dataset(tmp_dir, opt.n_images, dims)
+
+        # training augmentations as set in pix2pix.py
+        generator = DataGenerator([real_dir], [sim_dir], dim=dims, stdiz=False, normlz=True, thresh=True,
+                                  rshift=(0.025, 0.025), rzoom=None, brightlims=None, noise_var=None,
+                                  joint_aug=False, fused=opt.fused, uint8_output=opt.uint8_data,
+                                  batched=opt.batched_loading, read_threads=opt.read_threads)
+
+        for loader in opt.loaders:
+            for n_workers in opt.workers:
+                result = benchmark_loader(loader, n_workers, generator, opt)
+                results.append(result)
+                print('{:<8} {:>3} workers  first batch {:7.3f}s  {:9.1f} samples/s  peak rss {:8.1f}MB'.format(
+                    loader, n_workers, result['first_batch_s'], result['samples_per_s'], result['peak_rss_mb']))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if opt.output is not None:
+        with open(opt.output, 'w') as f:
+            json.dump({'environment': environment_info(), 'args': vars(opt), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=128, help="output image size")
+    parser.add_argument("--n_images", type=int, default=1024, help="image pairs in the synthetic dataset")
+    parser.add_argument("--batch_size", type=int, default=64, help="size of the batches")
+    parser.add_argument("--n_epochs", type=int, default=3, help="epochs per loader")
+    parser.add_argument("--loaders", type=str, nargs='+', default=['process', 'thread'], help="loaders to compare")
+    parser.add_argument("--workers", type=int, nargs='+', default=[2, 4, 8], help="worker processes or threads")
+    parser.add_argument("--prefetch_batches", type=int, default=2, help="batches prefetched per worker or thread")
+    parser.add_argument("--fused", type=str2bool, default=False, help="use the fused crop/gray/resize")
+    parser.add_argument("--uint8_data", type=str2bool, default=False, help="load uint8 images")
+    parser.add_argument("--batched_loading", type=str2bool, default=False, help="load and preprocess each batch as a single stack")
+    parser.add_argument("--read_threads", type=int, default=0, help="threads per worker for reading images in batched loading")
+    parser.add_argument("--output", type=str, default=None, help="json file to save the results to")
+    opt = parser.parse_args()
+
+    main(opt)
@@ -0,0 +1,202 @@
+'''
+Benchmarks for image_transforms on synthetic 640x480 BGR frames, for the
+augmentation_params combinations used by pix2pix.py (training) and
+gan_net.py (inference) at 64x64, 128x128 and 256x256.
+
+Reports per-op and end-to-end latency percentiles and throughput, and
+writes the results as json so runs can be compared, e.g.
+    python -m tactile_gym_sim2real.benchmarks.benchmark_image_transforms --output results.json
+    python -m tactile_gym_sim2real.benchmarks.benchmark_image_transforms --sizes 64 --ops process_image pipeline
+'''
+
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import cv2
+
+from tactile_gym_sim2real.image_transforms import process_image, process_images, threshold_image, \
+    per_image_standardisation, apply_affine_transform, load_video_frames, iter_video_frames, \
+    load_video_memmap, fused_crop_gray_resize, random_image_brightness, random_image_noise
+from tactile_gym_sim2real.preprocess_pipeline import PreprocessPipeline
+from tactile_gym_sim2real.benchmarks.fused_resize_report import synthetic_tactile_image
+
+bbox = [80, 25, 530, 475]
+
+# augmentation_params combinations, inference matches the overrides in gan_net.py
+configs = {
+    'inference': {
+        'rshift': None, 'rzoom': None, 'thresh': True, 'brightlims': None,
+        'noise_var': None, 'stdiz': False, 'normlz': True,
+    },
+    'train_default': {
+        'rshift': (0.025, 0.025), 'rzoom': None, 'thresh': True, 'brightlims': None,
+        'noise_var': None, 'stdiz': False, 'normlz': True,
+    },
+    'train_full_aug': {
+        'rshift': (0.025, 0.025), 'rzoom': (0.98, 1), 'thresh': True, 'brightlims': [0.3, 1.0, -50, 50],
+        'noise_var': 0.001, 'stdiz': False, 'normlz': True,
+    },
+    'train_stdiz': {
+        'rshift': (0.025, 0.025), 'rzoom': None, 'thresh': False, 'brightlims': None,
+        'noise_var': None, 'stdiz': True, 'normlz': False,
+    },
+}
+
+
+def synthetic_frames(n_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.stack([synthetic_tactile_image(rng) for _ in range(n_frames)])
+
+
+def time_op(func, n_iters, n_warmup=3, items_per_call=1):
+    ''' Runs func repeatedly and returns latency percentiles (ms per call)
+        and throughput (items per second).
+    '''
+    for _ in range(n_warmup):
+        func()
+
+    times = np.empty(n_iters)
+    for i in range(n_iters):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+
+    times_ms = times * 1000.0
+    return {
+        'n_iters': n_iters,
+        'items_per_call': items_per_call,
+        'mean_ms': float(times_ms.mean()),
+        'p50_ms': float(np.percentile(times_ms, 50)),
+        'p90_ms': float(np.percentile(times_ms, 90)),
+        'p99_ms': float(np.percentile(times_ms, 99)),
+        'max_ms': float(times_ms.max()),
+        'items_per_s': float(items_per_call * n_iters / times.sum()),
+    }
+
+
+def environment_info():
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'cv2_threads': cv2.getNumThreads(),
+    }
+
+
+def benchmark_size(size, frames, opt):
+    ''' Per-op and end-to-end benchmarks for one image size.
+    '''
+    dims = (size, size)
+    n_frames = len(frames)
+    results = []
+
+    def add(op, config, func, items_per_call=1):
+        if opt.ops is not None and op not in opt.ops:
+            return
+        result = time_op(func, opt.n_iters, opt.n_warmup, items_per_call)
+        result.update({'op': op, 'config': config, 'dims': size})
+        results.append(result)
+        print('{:>4} {:<26} {:<15} p50 {:8.3f}ms  p99 {:8.3f}ms  {:10.1f} img/s'.format(
+            size, op, config, result['p50_ms'], result['p99_ms'], result['items_per_s']))
+
+    # cycle through the frames so single image ops don't just hit the cache
+    counter = [0]
+    def next_frame():
+        counter[0] += 1
+        return frames[counter[0] % n_frames]
+
+    # individual stages, on inputs at the stage's position in the pipeline
+    resized = process_image(frames[0], gray=True, bbox=bbox, dims=dims)
+    add('gray_crop_resize', '-', lambda: process_image(next_frame(), gray=True, bbox=bbox, dims=dims))
+    add('fused_crop_gray_resize', '-', lambda: fused_crop_gray_resize(next_frame(), bbox, dims))
+    add('threshold_image', '-', lambda: threshold_image(resized[..., 0]))
+    add('per_image_standardisation', '-', lambda: per_image_standardisation(resized.astype(np.float32)))
+    add('apply_affine_transform', 'shift+zoom', lambda: apply_affine_transform(resized, tx=3.2, ty=-2.5, zx=0.99, zy=0.98))
+    add('random_image_brightness', '-', lambda: random_image_brightness(resized, [0.3, 1.0, -50, 50]))
+    add('random_image_noise', '-', lambda: random_image_noise(resized, 0.001))
+
+    # end-to-end per image and per batch for every config
+    for config_name, config in configs.items():
+        params = dict(config, dims=dims)
+        add('process_image', config_name, lambda: process_image(next_frame(), gray=True, bbox=bbox, **params))
+        add('process_images', config_name,
+            lambda: process_images(frames[:opt.batch_size], gray=True, bbox=bbox, **params),
+            items_per_call=len(frames[:opt.batch_size]))
+
+    # compiled pipeline as used by the real envs
+    pipeline = PreprocessPipeline(dict(configs['inference'], dims=dims), bbox=bbox)
+    add('pipeline', 'inference', lambda: pipeline(next_frame()))
+    pipeline = PreprocessPipeline(dict(configs['inference'], dims=dims, fused=True), bbox=bbox)
+    add('pipeline', 'inference_fused', lambda: pipeline(next_frame()))
+
+    return results
+
+
+def benchmark_video(frames, opt):
+    ''' Video decoding benchmarks on a synthetic recording.
+    '''
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        video_file = os.path.join(tmp_dir, 'tactile_video.mp4')
+        writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*'mp4v'), 20, (640, 480))
+        for i in range(opt.video_frames):
+            writer.write(frames[i % len(frames)])
+        writer.release()
+
+        load_video_memmap(video_file)
+
+        ops = {
+            'load_video_frames': lambda: load_video_frames(video_file),
+            'iter_video_frames': lambda: sum(1 for _ in iter_video_frames(video_file)),
+            'load_video_memmap': lambda: np.asarray(load_video_memmap(video_file)).sum(),
+        }
+        for op, func in ops.items():
+            if opt.ops is not None and op not in opt.ops:
+                continue
+            result = time_op(func, max(opt.n_iters // 20, 3), n_warmup=1, items_per_call=opt.video_frames)
+            result.update({'op': op, 'config': '-', 'dims': None})
+            results.append(result)
+            print('     {:<26} {:<15} p50 {:8.3f}ms  p99 {:8.3f}ms  {:10.1f} frames/s'.format(
+                op, '-', result['p50_ms'], result['p99_ms'], result['items_per_s']))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+def main(opt):
+
+    frames = synthetic_frames(max(opt.batch_size, 16))
+    results = []
+    for size in opt.sizes:
+        results += benchmark_size(size, frames, opt)
+    if opt.video_frames > 0:
+        results += benchmark_video(frames, opt)
+
+    if opt.output is not None:
+        with open(opt.output, 'w') as f:
+            json.dump({'environment': environment_info(), 'args': vars(opt), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[64, 128, 256], help="output image sizes")
+    parser.add_argument("--n_iters", type=int, default=200, help="timed calls per op")
+    parser.add_argument("--n_warmup", type=int, default=5, help="untimed calls per op before timing")
+    parser.add_argument("--batch_size", type=int, default=64, help="stack size for the batched ops")
+    parser.add_argument("--video_frames", type=int, default=200, help="frames in the synthetic video, 0 to skip")
+    parser.add_argument("--ops", type=str, nargs='+', default=None, help="only run these ops")
+    parser.add_argument("--output", type=str, default=None, help="json file to save the results to")
+    opt = parser.parse_args()
+
+    main(opt)
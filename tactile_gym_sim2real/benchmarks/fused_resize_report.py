@@ -0,0 +1,114 @@
+'''
+Accuracy and speed report for the fused crop/gray/resize mode compared with
+the gray -> bbox crop -> INTER_AREA resize path used by process_image.
+
+Run on collected real images with, e.g.
+    python fused_resize_report.py --image_dir ../data_collection/real/data/edge_2d/tap/csv_train/images
+or without --image_dir to use synthetic tactile-like frames.
+'''
+
+import os
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+
+from tactile_gym_sim2real.image_transforms import process_image, fused_crop_gray_resize, fused_supersample, threshold_image
+
+bbox = [80, 25, 530, 475]
+
+
+def synthetic_tactile_image(rng):
+    ''' 640x480 BGR frame of bright blurred pins on a dark background.
+    '''
+    image = np.full((480, 640, 3), 40, dtype=np.uint8)
+    for _ in range(330):
+        x, y = rng.integers(80, 560), rng.integers(20, 470)
+        cv2.circle(image, (int(x), int(y)), int(rng.integers(3, 7)), (220, 230, 235), -1)
+    image = cv2.GaussianBlur(image, (5, 5), 1.5)
+    noise = rng.integers(-8, 8, image.shape)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def load_images(image_dir, n_images, seed=0):
+    if image_dir is None:
+        rng = np.random.default_rng(seed)
+        return [synthetic_tactile_image(rng) for _ in range(n_images)]
+
+    image_files = sorted(glob.glob(os.path.join(image_dir, '*.png')))[:n_images]
+    return [cv2.imread(image_file) for image_file in image_files]
+
+
+def time_per_image(func, images, n_repeats):
+    func(images[0])
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        for image in images:
+            func(image)
+    return (time.perf_counter() - start) / (n_repeats * len(images)) * 1000.0
+
+
+def main(opt):
+
+    images = load_images(opt.image_dir, opt.n_images)
+    results = []
+
+    for size in opt.sizes:
+        dims = (size, size)
+
+        def reference(image):
+            return process_image(image, gray=True, bbox=bbox, dims=dims)[..., 0]
+
+        ref_images = [reference(image) for image in images]
+        ref_thresh = [threshold_image(image) for image in ref_images]
+        ref_ms = time_per_image(reference, images, opt.n_repeats)
+
+        auto = fused_supersample(tuple(bbox), dims)
+        for supersample in sorted(set([auto] + opt.supersample)):
+
+            def fused(image):
+                return fused_crop_gray_resize(image, bbox, dims, supersample=supersample)
+
+            diffs = np.stack([np.abs(fused(image).astype(np.int16) - ref) for image, ref in zip(images, ref_images)])
+            thresh_diffs = np.stack([threshold_image(fused(image)) != ref for image, ref in zip(images, ref_thresh)])
+
+            results.append({
+                'dims': size,
+                'supersample': supersample,
+                'default': supersample == auto,
+                'mean_abs_error': float(diffs.mean()),
+                'max_abs_error': int(diffs.max()),
+                'pixels_differing': float((diffs > 0).mean()),
+                'thresh_pixels_differing': float(thresh_diffs.mean()),
+                'reference_ms': ref_ms,
+                'fused_ms': time_per_image(fused, images, opt.n_repeats),
+            })
+
+    print('{:>5} {:>4} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8}'.format(
+        'dims', 'ss', 'mae', 'max', 'diff%', 'thresh%', 'ref_ms', 'fused_ms'))
+    for r in results:
+        print('{:>5} {:>3}{} {:>8.3f} {:>8d} {:>8.2f} {:>10.3f} {:>8.3f} {:>8.3f}'.format(
+            r['dims'], r['supersample'], '*' if r['default'] else ' ',
+            r['mean_abs_error'], r['max_abs_error'], 100 * r['pixels_differing'],
+            100 * r['thresh_pixels_differing'], r['reference_ms'], r['fused_ms']))
+    print('* default supersampling')
+
+    if opt.output is not None:
+        with open(opt.output, 'w') as f:
+            json.dump({'image_dir': opt.image_dir, 'n_images': len(images), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=str, default=None, help="dir of raw real images, synthetic frames if not set")
+    parser.add_argument("--n_images", type=int, default=50, help="number of images to compare")
+    parser.add_argument("--n_repeats", type=int, default=5, help="timing repeats over the image set")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[64, 128, 256], help="output image sizes")
+    parser.add_argument("--supersample", type=int, nargs='+', default=[1, 2, 4], help="supersampling factors to compare")
+    parser.add_argument("--output", type=str, default=None, help="json file to save the results to")
+    opt = parser.parse_args()
+
+    main(opt)
@@ -0,0 +1,229 @@
+'''
+Find near-duplicate real tactile images with perceptual hashes and thin the
+dataset to one image per cluster while keeping pose coverage.
+
+Each image under data/<task>/<tap|shear>[/<size>]/csv_*/images is converted
+to gray scale (and cropped to the sensor bbox if raw) and reduced to a 64 bit
+DCT hash. The hashes are stored beside targets.csv in phash_index.npz and
+reused until targets.csv changes. Images are clustered greedily, each image
+within --max_distance bits of an earlier cluster leader joins its cluster.
+
+The thinned dataset keeps every cluster leader, plus the first image of any
+pose bin that would otherwise be left empty, with each varying pose dim of
+each object binned separately into --pose_bins bins, and is written as
+targets_thinned.csv beside targets.csv with a phash_clusters.csv report.
+With --replace the thinned targets become targets.csv (the original is kept
+as targets_full.csv), real/sim pairing then simply drops the removed images.
+
+    python dedupe_real_data.py --tasks spherical_probe --data_dirs tap --max_distance 4
+'''
+
+import os
+import time
+import shutil
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import cv2
+
+from tactile_gym.utils.general_utils import str2bool
+from tactile_gym_sim2real.image_transforms import process_image
+from tactile_gym_sim2real.worker_utils import available_cores, init_worker
+
+bbox = [80, 25, 530, 475]
+raw_shape = (480, 640)
+index_filename = 'phash_index.npz'
+
+# popcount of every byte, for hamming distances between packed hashes
+_byte_bits = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def image_hash(image, hash_size=8):
+    ''' 64 bit DCT perceptual hash of an image, as 8 packed bytes.
+    '''
+    if image.shape[:2] == raw_shape:
+        image = process_image(image, gray=True, bbox=bbox)[..., 0]
+    elif image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # low frequencies of a small copy, thresholded at their median
+    small = cv2.resize(image, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:hash_size, :hash_size]
+    return np.packbits(low_freq > np.median(low_freq))
+
+
+def _hash_file(image_file):
+    return image_hash(cv2.imread(image_file))
+
+
+def hamming_distances(hash, hashes):
+    ''' Bits differing between one (8,) hash and an (N,8) array of hashes.
+    '''
+    return _byte_bits[np.bitwise_xor(hashes, hash)].sum(axis=1, dtype=np.int32)
+
+
+def load_hash_index(data_dir, pool=None, rebuild=False):
+    ''' Hashes of the images listed in targets.csv, in targets order, cached
+        in phash_index.npz until targets.csv is modified.
+    '''
+    targets_file = os.path.join(data_dir, 'targets.csv')
+    index_file = os.path.join(data_dir, index_filename)
+    targets_mtime = os.path.getmtime(targets_file)
+    sensor_images = pd.read_csv(targets_file, usecols=['sensor_image'])['sensor_image'].to_numpy(dtype=str)
+
+    if not rebuild and os.path.isfile(index_file):
+        with np.load(index_file) as cached:
+            if cached['targets_mtime'] == targets_mtime and np.array_equal(cached['sensor_images'], sensor_images):
+                return cached['hashes']
+
+    image_files = [os.path.join(data_dir, 'images', sensor_image) for sensor_image in sensor_images]
+    if pool is not None:
+        hashes = np.stack(pool.map(_hash_file, image_files, chunksize=32))
+    else:
+        hashes = np.stack([_hash_file(image_file) for image_file in image_files])
+
+    tmp_file = '{}.{}.tmp.npz'.format(index_file[:-4], os.getpid())
+    np.savez(tmp_file, targets_mtime=targets_mtime, sensor_images=sensor_images, hashes=hashes)
+    os.replace(tmp_file, index_file)
+
+    return hashes
+
+
+def cluster_hashes(hashes, max_distance):
+    ''' Greedy leader clustering, each image joins the cluster of the first
+        earlier leader within max_distance bits or starts a new cluster.
+        Returns the cluster id and distance to the leader of every image.
+    '''
+    clusters = np.full(len(hashes), -1, dtype=np.int32)
+    distances = np.zeros(len(hashes), dtype=np.int32)
+    n_clusters = 0
+    for i in range(len(hashes)):
+        if clusters[i] >= 0:
+            continue
+        unassigned = np.flatnonzero(clusters < 0)
+        dist = hamming_distances(hashes[i], hashes[unassigned])
+        members = unassigned[dist <= max_distance]
+        clusters[members] = n_clusters
+        distances[members] = dist[dist <= max_distance]
+        n_clusters += 1
+
+    return clusters, distances
+
+
+def pose_bins(targets_df, n_bins):
+    ''' Bin ids of every row per object, one array for each varying pose
+        column binned on its own, or the object ids if no pose column varies.
+        Binning the columns jointly would give close to one bin per image.
+    '''
+    pose_cols = [col for col in targets_df.columns if col.startswith('pose_') and col != 'pose_id']
+    pose_cols = [col for col in pose_cols if targets_df[col].nunique() > 1]
+
+    if 'obj_id' in targets_df.columns:
+        obj_ids = targets_df['obj_id'].to_numpy()
+    else:
+        obj_ids = np.zeros(len(targets_df), dtype=np.int64)
+
+    if not pose_cols:
+        return [pd.factorize(obj_ids)[0]]
+
+    bins = []
+    for col in pose_cols:
+        values = targets_df[col].to_numpy(dtype=np.float64)
+        edges = np.linspace(values.min(), values.max(), n_bins + 1)[1:-1]
+        bins.append(pd.MultiIndex.from_arrays([obj_ids, np.digitize(values, edges)]).factorize()[0])
+    return bins
+
+
+def thin_targets(targets_df, clusters, n_pose_bins):
+    ''' Keeps each cluster leader, and the first image of any pose bin
+        without a kept image in it. Returns the rows to keep and the number
+        of occupied pose bins.
+    '''
+    keep = np.zeros(len(targets_df), dtype=bool)
+    keep[np.unique(clusters, return_index=True)[1]] = True
+
+    n_occupied_bins = 0
+    for bins in pose_bins(targets_df, n_pose_bins):
+        covered = np.unique(bins[keep])
+        uncovered = ~np.isin(bins, covered)
+        first_in_bin = np.unique(bins[uncovered], return_index=True)[1]
+        keep[np.flatnonzero(uncovered)[first_in_bin]] = True
+        n_occupied_bins += len(np.unique(bins))
+
+    return keep, n_occupied_bins
+
+
+def dedupe_dir(data_dir, opt, pool=None):
+    targets_file = os.path.join(data_dir, 'targets.csv')
+    targets_df = pd.read_csv(targets_file)
+
+    hashes = load_hash_index(data_dir, pool, opt.rebuild)
+    clusters, distances = cluster_hashes(hashes, opt.max_distance)
+    keep, n_occupied_bins = thin_targets(targets_df, clusters, opt.pose_bins)
+
+    report_df = pd.DataFrame({
+        'sensor_image': targets_df['sensor_image'],
+        'cluster': clusters,
+        'cluster_size': np.bincount(clusters)[clusters],
+        'distance': distances,
+        'keep': keep,
+    })
+    report_df.to_csv(os.path.join(data_dir, 'phash_clusters.csv'), index=False)
+
+    thinned_df = targets_df[keep].reset_index(drop=True)
+    thinned_df.to_csv(os.path.join(data_dir, 'targets_thinned.csv'), index=False)
+
+    if opt.replace:
+        full_file = os.path.join(data_dir, 'targets_full.csv')
+        if not os.path.isfile(full_file):
+            shutil.copy2(targets_file, full_file)
+        thinned_df.to_csv(targets_file, index=False)
+
+    cluster_sizes = np.bincount(clusters)
+    print('{}: {} images, {} clusters (largest {}, {} with duplicates), {} occupied pose bins, keeping {}'.format(
+        data_dir, len(targets_df), len(cluster_sizes), cluster_sizes.max(),
+        np.sum(cluster_sizes > 1), n_occupied_bins, keep.sum()))
+
+    return len(targets_df), int(keep.sum())
+
+
+def main(opt):
+
+    start_time = time.time()
+    data_dirs = []
+    for task in opt.tasks:
+        for data_dir in opt.data_dirs:
+            for split in opt.splits:
+                path = os.path.join(opt.data_root, task, data_dir, *([opt.size_dir] if opt.size_dir else []), split)
+                if os.path.isfile(os.path.join(path, 'targets.csv')):
+                    data_dirs.append(path)
+
+    n_images, n_kept = 0, 0
+    with mp.Pool(opt.n_workers, initializer=init_worker) as pool:
+        for data_dir in data_dirs:
+            n, k = dedupe_dir(data_dir, opt, pool)
+            n_images += n
+            n_kept += k
+
+    print('')
+    print('Kept {} of {} images ({:.1f}%) in {} dirs, total time {:.1f}s'.format(
+        n_kept, n_images, 100 * n_kept / max(n_images, 1), len(data_dirs), time.time() - start_time))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", type=str, default='data', help="root of the collected real data")
+    parser.add_argument("--tasks", type=str, nargs='+', default=['edge_2d', 'surface_3d', 'spherical_probe'], help="task dirs to process")
+    parser.add_argument("--data_dirs", type=str, nargs='+', default=['tap', 'shear'], help="data dirs within each task")
+    parser.add_argument("--size_dir", type=str, default=None, help="processed size dir within each data dir, e.g. 128x128, raw images if not set")
+    parser.add_argument("--splits", type=str, nargs='+', default=['csv_train'], help="splits within each data dir")
+    parser.add_argument("--max_distance", type=int, default=4, help="hash bits that can differ between near-duplicates")
+    parser.add_argument("--pose_bins", type=int, default=5, help="bins per varying pose dim that must keep an image")
+    parser.add_argument("--replace", type=str2bool, default=False, help="write the thinned targets as targets.csv, keeping targets_full.csv")
+    parser.add_argument("--rebuild", type=str2bool, default=False, help="rehash images even if the index is up to date")
+    parser.add_argument("--n_workers", type=int, default=available_cores(), help="processes hashing images")
+    opt = parser.parse_args()
+
+    main(opt)
@@ -0,0 +1,133 @@
+'''
+Preprocess collected real tactile images at several GAN resolutions at once.
+
+Each raw 640x480 image under data/<task>/<tap|shear>/csv_*/images is decoded
+once, converted to gray scale and cropped to the sensor bbox, then resized
+and thresholded to every requested size, mirroring the sim layout as
+data/<task>/<tap|shear>/<W>x<H>/csv_*/images (<W>x<H>_gray without
+thresholding). Work is spread over a process pool, outputs newer than their
+source image are skipped so an interrupted run resumes where it stopped.
+
+    python preprocess_real_data.py --tasks edge_2d surface_3d --sizes 64 128 256
+'''
+
+import os
+import time
+import shutil
+import argparse
+import multiprocessing as mp
+import pandas as pd
+import cv2
+
+from tactile_gym.utils.general_utils import str2bool
+from tactile_gym_sim2real.image_transforms import process_image
+from tactile_gym_sim2real.worker_utils import available_cores, init_worker
+
+bbox = [80, 25, 530, 475]
+
+
+def size_str(size, thresh=True):
+    ''' Output dir name for a size, unthresholded images are kept separate.
+    '''
+    return '{}x{}'.format(size, size) + ('' if thresh else '_gray')
+
+
+def find_jobs(data_root, tasks, data_dirs, splits, sizes, thresh=True, overwrite=False):
+    ''' Lists (source image, [(output image, size), ...]) for every image with
+        at least one missing or stale output, and the number of images skipped.
+    '''
+    jobs, n_skipped = [], 0
+    for task in tasks:
+        for data_dir in data_dirs:
+            for split in splits:
+                split_dir = os.path.join(data_root, task, data_dir, split)
+                targets_file = os.path.join(split_dir, 'targets.csv')
+                if not os.path.isfile(targets_file):
+                    continue
+
+                # copy the targets beside each set of processed images
+                out_dirs = {size: os.path.join(data_root, task, data_dir, size_str(size, thresh), split) for size in sizes}
+                for out_dir in out_dirs.values():
+                    os.makedirs(os.path.join(out_dir, 'images'), exist_ok=True)
+                    shutil.copy2(targets_file, os.path.join(out_dir, 'targets.csv'))
+
+                for sensor_image in pd.read_csv(targets_file, usecols=['sensor_image'])['sensor_image']:
+                    src = os.path.join(split_dir, 'images', sensor_image)
+                    src_mtime = os.path.getmtime(src)
+                    outputs = [
+                        (os.path.join(out_dirs[size], 'images', sensor_image), size) for size in sizes
+                    ]
+                    if not overwrite:
+                        outputs = [
+                            (dst, size) for dst, size in outputs
+                            if not os.path.isfile(dst) or os.path.getmtime(dst) < src_mtime
+                        ]
+                    if outputs:
+                        jobs.append((src, outputs))
+                    else:
+                        n_skipped += 1
+
+    return jobs, n_skipped
+
+
+def process_job(job, thresh=True):
+    ''' Decode one raw image and write all of its outputs, returns the number
+        of images written.
+    '''
+    src, outputs = job
+    image = cv2.imread(src)
+    image = process_image(image, gray=True, bbox=bbox)
+
+    for dst, size in outputs:
+        out_image = process_image(image, gray=False, dims=(size, size), thresh=thresh)
+
+        # write then rename so an interrupted run never leaves a partial image
+        tmp_dst = dst[:-4] + '.tmp' + dst[-4:]
+        cv2.imwrite(tmp_dst, out_image)
+        os.replace(tmp_dst, dst)
+
+    return len(outputs)
+
+
+def _process_job(args):
+    return process_job(*args)
+
+
+def main(opt):
+
+    start_time = time.time()
+    jobs, n_skipped = find_jobs(opt.data_root, opt.tasks, opt.data_dirs, opt.splits, opt.sizes, opt.thresh, opt.overwrite)
+    print('{} images to process, {} up to date'.format(len(jobs), n_skipped))
+
+    n_written = 0
+    process_start_time = time.time()
+    if jobs:
+        with mp.Pool(opt.n_workers, initializer=init_worker) as pool:
+            results = pool.imap_unordered(_process_job, [(job, opt.thresh) for job in jobs], chunksize=opt.chunksize)
+            for i, n in enumerate(results):
+                n_written += n
+                if (i + 1) % 1000 == 0:
+                    print('{}/{} images'.format(i + 1, len(jobs)))
+
+    process_time = time.time() - process_start_time
+    print('')
+    print('Decoded {} images, wrote {} outputs at sizes {} with {} workers'.format(len(jobs), n_written, opt.sizes, opt.n_workers))
+    print('Processing time {:.1f}s ({:.1f} images/s, {:.1f} outputs/s), total time {:.1f}s'.format(
+        process_time, len(jobs) / max(process_time, 1e-9), n_written / max(process_time, 1e-9), time.time() - start_time))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", type=str, default='data', help="root of the collected real data")
+    parser.add_argument("--tasks", type=str, nargs='+', default=['edge_2d', 'surface_3d', 'spherical_probe'], help="task dirs to process")
+    parser.add_argument("--data_dirs", type=str, nargs='+', default=['tap', 'shear'], help="data dirs within each task")
+    parser.add_argument("--splits", type=str, nargs='+', default=['csv_train', 'csv_val'], help="splits within each data dir")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[64, 128, 256], help="output image sizes")
+    parser.add_argument("--thresh", type=str2bool, default=True, help="adaptive threshold the resized images")
+    parser.add_argument("--n_workers", type=int, default=available_cores(), help="processes in the pool")
+    parser.add_argument("--chunksize", type=int, default=16, help="images sent to a worker at a time")
+    parser.add_argument("--overwrite", type=str2bool, default=False, help="reprocess up to date images")
+    opt = parser.parse_args()
+
+    main(opt)
@@ -2,11 +2,14 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import os
+import io
 import numpy as np
-import scipy
 import cv2
-from skimage.util import random_noise
-from scipy.ndimage import zoom
+from functools import lru_cache
+
+from tactile_gym_sim2real.batch_augmentation import random_images_brightness, random_images_noise
+from scipy.ndimage import zoom, affine_transform
 import json
 
 # Save the dictionaries
@@ -36,10 +39,51 @@ def pixel_diff_norm(frames):
     ''' Computes the mean pixel difference between the first frame and the
         remaining frames in a Numpy array of frames.
     '''
-    n, h, w, c = frames.shape
-    pdn = [cv2.norm(frames[i], frames[0], cv2.NORM_L1) / (h * w) for i in range(1, n)]
+    return pixel_diff_norms(frames, reference='first', norm='l1')
+
+def pixel_diff_norms(frames, reference='first', norm='l1'):
+    ''' Generalised pixel_diff_norm. Computes the L1 or L2 norm of the pixel
+        difference (divided by h*w) between each frame and a reference, which
+        is either the 'first' frame, the 'previous' frame or a given image.
+        Frames can be a Numpy array or any iterable of frames, e.g.
+        iter_video_frames, so long videos can be streamed a frame at a time.
+        With 'first' or 'previous' there is no value for the first frame.
+    '''
+    norm_types = {'l1': cv2.NORM_L1, 'l2': cv2.NORM_L2}
+    if norm not in norm_types:
+        raise ValueError('`norm` should be one of l1 or l2. Received: %s' % (norm,))
+
+    if isinstance(reference, str):
+        if reference not in ('first', 'previous'):
+            raise ValueError('`reference` should be first, previous or an image. Received: %s' % (reference,))
+        mode, ref = reference, None
+    else:
+        mode, ref = 'image', reference
+
+    # cv2.norm per frame is simd optimised and memory bound, a Numpy
+    # reduction over a chunk of frames is much slower
+    pdn = []
+    for frame in frames:
+        if ref is None:
+            # first frame only provides the reference
+            ref = frame
+            continue
+
+        h, w = frame.shape[:2]
+        pdn.append(cv2.norm(frame, ref, norm_types[norm]) / (h * w))
+
+        if mode == 'previous':
+            ref = frame
+
     return np.array(pdn)
 
+def video_pixel_diff_norms(filename, reference='first', norm='l1', start=0, stop=None, step=1):
+    ''' Streams pixel_diff_norms straight from specified video 'filename',
+        holding only the current and reference frames in memory.
+    '''
+    frames = iter_video_frames(filename, start=start, stop=stop, step=step)
+    return pixel_diff_norms(frames, reference=reference, norm=norm)
+
 def load_video_frames(filename):
     ''' Loads frames from specified video 'filename' and returns them as a
         Numpy array.
@@ -57,10 +101,103 @@ def load_video_frames(filename):
         vc.release()
     return np.array(frames)
 
+def iter_video_frames(filename, start=0, stop=None, step=1):
+    ''' Lazily yields frames start:stop:step from specified video 'filename'
+        so that only one decoded frame is held in memory at a time.
+    '''
+    vc = cv2.VideoCapture(filename)
+    try:
+        if not vc.isOpened():
+            return
+
+        # skip to the start frame without retrieving the skipped frames
+        for _ in range(start):
+            if not vc.grab():
+                return
+
+        i = start
+        while stop is None or i < stop:
+            captured, frame = vc.read()
+            if not captured:
+                return
+            yield frame
+
+            # skip the frames between strides
+            for _ in range(step - 1):
+                if not vc.grab():
+                    return
+            i += step
+    finally:
+        vc.release()
+
+def _npy_header(shape, dtype):
+    buffer = io.BytesIO()
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape}
+    np.lib.format.write_array_header_1_0(buffer, header)
+    return buffer.getvalue()
+
+def load_video_memmap(filename, cache_file=None):
+    ''' Returns all frames of specified video 'filename' as a read only
+        (n,h,w,c) memmap. The video is decoded once, streaming frames into
+        an on disk .npy cache file, later calls open the cache without
+        decoding unless the video has changed since.
+    '''
+    if cache_file is None:
+        cache_file = os.path.splitext(filename)[0] + '_frames.npy'
+
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(filename):
+        return np.load(cache_file, mmap_mode='r')
+
+    vc = cv2.VideoCapture(filename)
+    n_estimate = max(int(vc.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+    vc.release()
+
+    tmp_file = cache_file + '.tmp'
+    n_frames, frame_shape = 0, (0, 0, 0)
+    with open(tmp_file, 'wb') as f:
+        for frame in iter_video_frames(filename):
+            if n_frames == 0:
+                # header sized for the reported frame count, corrected below
+                frame_shape = frame.shape
+                header = _npy_header((n_estimate, *frame_shape), frame.dtype)
+                f.write(header)
+            f.write(frame.tobytes())
+            n_frames += 1
+
+        if n_frames == 0:
+            header = _npy_header((0, *frame_shape), np.uint8)
+            f.write(header)
+
+    # the reported frame count is only an estimate for some codecs
+    if n_frames != n_estimate:
+        new_header = _npy_header((n_frames, *frame_shape), np.uint8)
+        if len(new_header) == len(header):
+            with open(tmp_file, 'r+b') as f:
+                f.write(new_header)
+        else:
+            with open(tmp_file, 'rb') as src, open(tmp_file + '.hdr', 'wb') as dst:
+                src.seek(len(header))
+                dst.write(new_header)
+                while True:
+                    chunk = src.read(1 << 24)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            os.replace(tmp_file + '.hdr', tmp_file)
+
+    os.replace(tmp_file, cache_file)
+    return np.load(cache_file, mmap_mode='r')
+
 
-def process_image(image, gray=True, bbox=None, dims=None, stdiz=False, normlz=False, rshift=None, rzoom=None, thresh=False, add_axis=False, brightlims=None, noise_var=None):
+def process_image(image, gray=True, bbox=None, dims=None, stdiz=False, normlz=False, rshift=None, rzoom=None, thresh=False, add_axis=False, brightlims=None, noise_var=None, fused=False, noise_bank=None, stdiz_stats=None):
     ''' Process raw image (e.g., before applying to neural network).
     '''
+    if fused and gray and dims is not None:
+        # Crop, gray scale and resize in one pass with precomputed remap tables
+        image = fused_crop_gray_resize(image, bbox, dims)
+        image = image[..., np.newaxis]
+        gray, bbox, dims = False, None, None
+
     if gray:
         # Convert to gray scale
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -86,14 +223,9 @@ def process_image(image, gray=True, bbox=None, dims=None, stdiz=False, normlz=Fa
         # Add channel axis
         image = image[..., np.newaxis]
 
-    if rshift is not None:
-        # Apply random shift to image
-        wrg, hrg = rshift
-        image = random_shift_image(image, wrg, hrg)
-
-    if rzoom is not None:
-        # Apply random zoom to image
-        image = random_zoom_image(image,rzoom)
+    if rshift is not None or rzoom is not None:
+        # Apply random shift and zoom to image as a single affine transform
+        image = random_affine_image(image, shift_range=rshift, zoom_range=rzoom)
 
     if thresh:
         # Use adaptive thresholding to create binary image
@@ -106,9 +238,13 @@ def process_image(image, gray=True, bbox=None, dims=None, stdiz=False, normlz=Fa
 
     if noise_var is not None:
         # Add random noise to the image
-        image = random_image_noise(image, noise_var)
+        image = random_image_noise(image, noise_var, noise_bank)
 
-    if stdiz:
+    if stdiz == 'dataset':
+        # Convert to float and standardise with fixed dataset constants
+        image = dataset_standardisation(image.astype(np.float32), stdiz_stats)
+
+    elif stdiz:
         # Convert to float and standardise on a per frame basis
         # position of this is important
         image = per_image_standardisation(image.astype(np.float32))
@@ -120,67 +256,235 @@ def process_image(image, gray=True, bbox=None, dims=None, stdiz=False, normlz=Fa
 
     return image
 
+def process_images(images, gray=True, bbox=None, dims=None, stdiz=False, normlz=False, rshift=None, rzoom=None, thresh=False, add_axis=False, brightlims=None, noise_var=None, fused=False, noise_bank=None, stdiz_stats=None):
+    ''' Process a stack of raw images with shape (N,H,W,C), giving the same
+        result as calling process_image on each image in turn.
+    '''
+    if fused and gray and dims is not None:
+        # Crop, gray scale and resize each frame in one pass with precomputed remap tables
+        images = np.stack([fused_crop_gray_resize(image, bbox, dims) for image in images])
+        images = images[..., np.newaxis]
+        gray, bbox, dims = False, None, None
+
+    if bbox is not None:
+        # Crop to specified bounding box, before gray scale as that works per pixel
+        x0, y0, x1, y1 = bbox
+        images = images[:, y0:y1, x0:x1]
+
+    if gray:
+        # Convert to gray scale
+        images = gray_images(images)
+
+    if dims is not None:
+        if isinstance(dims, list):
+            dims=tuple(dims)
+
+        # Resize to specified dims
+        images = resize_images(images, dims)
+
+    if add_axis:
+        # Add channel axis
+        images = images[..., np.newaxis]
+
+    if rshift is not None or rzoom is not None:
+        # Apply random shift and zoom to each image as a single affine transform
+        images = np.stack([random_affine_image(image, shift_range=rshift, zoom_range=rzoom) for image in images])
+
+    if thresh:
+        # Use adaptive thresholding to create binary images
+        images = threshold_images(images)
+
+    if brightlims is not None:
+        # Add random brightness/contrast variation to each image
+        images = random_images_brightness(images, brightlims)
+
+    if noise_var is not None:
+        # Add random noise to each image
+        images = random_images_noise(images, noise_var, bank=noise_bank)
+
+    if stdiz == 'dataset':
+        # Convert to float and standardise with fixed dataset constants
+        images = dataset_standardisation(images.astype(np.float32), stdiz_stats)
+
+    elif stdiz:
+        # Convert to float and standardise on a per frame basis
+        images = per_image_standardisation(images.astype(np.float32), axis=(1,2))
+
+    if normlz:
+        # Convert to float and normalise
+        images = images.astype(np.float32) / 255.0
+
+    return images
+
+def gray_images(images):
+    ''' Converts a stack of (N,H,W,3) BGR images to a contiguous (N,H,W,1)
+        gray scale stack, writing each frame straight into the output.
+    '''
+    n, h, w, c = images.shape
+    gray = np.empty((n, h, w), dtype=images.dtype)
+    for i in range(n):
+        cv2.cvtColor(images[i], cv2.COLOR_BGR2GRAY, dst=gray[i])
+    return gray[..., np.newaxis]
+
+def resize_images(images, dims):
+    ''' Resizes a stack of (N,H,W,C) images with INTER_AREA in a single cv2
+        call by treating the stack as one tall image. Frame boundaries land
+        exactly on output rows so each frame matches an individual resize.
+    '''
+    n, h, w, c = images.shape
+    tall_image = np.ascontiguousarray(images).reshape(n * h, w, c)
+    tall_image = cv2.resize(tall_image, (dims[0], n * dims[1]), interpolation=cv2.INTER_AREA)
+    return tall_image.reshape(n, dims[1], dims[0], c)
+
+def threshold_images(images):
+    ''' Applies threshold_image to a stack of (N,H,W,1) images in a single
+        cv2 call. Each frame is edge padded by half the block size so the
+        tall image thresholds exactly as the individual frames would.
+    '''
+    n, h, w, c = images.shape
+    pad = threshold_block_size // 2
+    tall_image = np.pad(images[..., 0], ((0, 0), (pad, pad), (0, 0)), mode='edge')
+    tall_image = threshold_image(tall_image.reshape(n * (h + 2*pad), w))
+    return tall_image.reshape(n, h + 2*pad, w)[:, pad:-pad, :, np.newaxis]
+
+@lru_cache(maxsize=32)
+def crop_resize_maps(bbox, dims, supersample):
+    ''' Precomputes fixed point remap tables sampling the bounding box on a
+        grid supersample times finer than dims, cached per configuration.
+    '''
+    x0, y0, x1, y1 = bbox
+    scale_x = (x1 - x0) / (dims[0] * supersample)
+    scale_y = (y1 - y0) / (dims[1] * supersample)
+
+    # sample at the centre of each output pixel (pixel centres are at +0.5)
+    map_x = x0 + (np.arange(dims[0] * supersample) + 0.5) * scale_x - 0.5
+    map_y = y0 + (np.arange(dims[1] * supersample) + 0.5) * scale_y - 0.5
+    map_x, map_y = np.meshgrid(map_x.astype(np.float32), map_y.astype(np.float32))
+
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+def fused_supersample(bbox, dims):
+    ''' Default supersampling for the fused crop and resize, enough to keep
+        aliasing low at large downscales while staying cheaper than INTER_AREA.
+    '''
+    x0, y0, x1, y1 = bbox
+    scale = max((x1 - x0) / dims[0], (y1 - y0) / dims[1])
+    return max(1, int(scale // 3))
+
+def fused_crop_gray_resize(image, bbox, dims, supersample=None, dst=None):
+    ''' Approximates the gray, bbox crop and INTER_AREA resize stages of
+        process_image by bilinearly sampling only the required pixels of the
+        raw BGR image, then converting the small result to gray scale.
+    '''
+    if bbox is None:
+        bbox = (0, 0, image.shape[1], image.shape[0])
+    bbox, dims = tuple(bbox), tuple(dims)
+    if supersample is None:
+        supersample = fused_supersample(bbox, dims)
+
+    map_1, map_2 = crop_resize_maps(bbox, dims, supersample)
+    image = cv2.remap(image, map_1, map_2, cv2.INTER_LINEAR)
+
+    if supersample > 1:
+        # Integer factor area reduction of the supersampled grid
+        image = cv2.resize(image, dims, interpolation=cv2.INTER_AREA)
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+
+# adaptive threshold neighbourhood size and offset from its mean, shared by
+# the per image, batched and pipeline thresholding
+threshold_block_size = 11
+threshold_offset = -30
+
 def threshold_image(image):
-    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, -30)
+    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                  threshold_block_size, threshold_offset)
     # image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, -20)
     return image
 
 # Change brightness levels
 def random_image_brightness(image, brightlims):
+    return random_images_brightness(image[np.newaxis], brightlims)[0]
 
-    if image.dtype != np.uint8:
-        raise ValueError('This random brightness should only be applied to uint8 images on a 0-255 scale')
-
-    a1,a2,b1,b2 = brightlims
-    alpha = np.random.uniform(a1,a2)  # Simple contrast control
-    beta =  np.random.randint(b1,b2)  # Simple brightness control
-    new_image = np.clip(alpha*image + beta, 0, 255).astype(np.uint8)
-
-    return new_image
-
-def random_image_noise(image, noise_var):
-    new_image = random_noise(image, var=noise_var)
-    return new_image
+def random_image_noise(image, noise_var, noise_bank=None):
+    # keeps the dtype and scale of the image, unlike skimage random_noise
+    return random_images_noise(image[np.newaxis], noise_var, bank=noise_bank)[0]
 
-def per_image_standardisation(image):
-    mean = np.mean(image, axis=(0,1), keepdims=True)
-    std = np.sqrt(((image - mean)**2).mean(axis=(0,1), keepdims=True))
+def per_image_standardisation(image, axis=(0,1)):
+    mean = np.mean(image, axis=axis, keepdims=True)
+    std = np.sqrt(((image - mean)**2).mean(axis=axis, keepdims=True))
     t_image = (image - mean) / std
     return t_image
 
+def dataset_standardisation(image, stats):
+    ''' Standardise with a mean and std gathered over a whole dataset (see
+        pix2pix/dataset_stats.py), in place for float32 images.
+    '''
+    if stats is None:
+        raise ValueError("stdiz='dataset' needs stdiz_stats with the dataset mean and std")
+    image -= np.float32(stats['mean'])
+    image *= np.float32(1.0 / stats['std'])
+    return image
+
 def random_shift_image(x, wrg, hrg, fill_mode='nearest', cval=0.):
     """Performs a random spatial shift of a Numpy image tensor.
     """
-    h, w = x.shape[0], x.shape[1]
-    tx = np.random.uniform(-hrg, hrg) * h
-    ty = np.random.uniform(-wrg, wrg) * w
-    x = apply_affine_transform(x, tx=tx, ty=ty, fill_mode=fill_mode, cval=cval)
-    return x
+    return random_affine_image(x, shift_range=(wrg, hrg), fill_mode=fill_mode, cval=cval)
 
 
 def random_zoom_image(x, zoom_range, fill_mode='nearest', cval=0.):
     """Performs a random spatial zoom of a Numpy image tensor.
     """
-    if len(zoom_range) != 2:
-        raise ValueError('`zoom_range` should be a tuple or list of two'
-                         ' floats. Received: %s' % (zoom_range,))
+    return random_affine_image(x, zoom_range=zoom_range, fill_mode=fill_mode, cval=cval)
 
-    if zoom_range[0] == 1 and zoom_range[1] == 1:
-        zx, zy = 1, 1
-    else:
-        zx, zy = np.random.uniform(zoom_range[0], zoom_range[1], 2)
 
-    x = apply_affine_transform(x, zx=zx, zy=zy, fill_mode=fill_mode, cval=cval)
-    return x
+def random_affine_image(x, shift_range=None, zoom_range=None, fill_mode='nearest', cval=0.):
+    """Performs a random spatial shift and/or zoom of a Numpy image tensor,
+    sampled together and applied as a single affine transformation. The
+    parameters are drawn in the same order as random_shift_image followed
+    by random_zoom_image.
+    """
+    h, w = x.shape[0], x.shape[1]
+
+    tx, ty = 0, 0
+    if shift_range is not None:
+        wrg, hrg = shift_range
+        tx = np.random.uniform(-hrg, hrg) * h
+        ty = np.random.uniform(-wrg, wrg) * w
+
+    zx, zy = 1, 1
+    if zoom_range is not None:
+        if len(zoom_range) != 2:
+            raise ValueError('`zoom_range` should be a tuple or list of two'
+                             ' floats. Received: %s' % (zoom_range,))
+
+        if zoom_range[0] != 1 or zoom_range[1] != 1:
+            zx, zy = np.random.uniform(zoom_range[0], zoom_range[1], 2)
+
+    return apply_affine_transform(x, tx=tx, ty=ty, zx=zx, zy=zy, fill_mode=fill_mode, cval=cval)
+
+
+# scipy.ndimage fill modes and their cv2 border equivalents, cv2 wraps with
+# a period of the image size (scipy's 'grid-wrap') so 'wrap' stays on scipy
+fill_mode_borders = {
+    'nearest':  cv2.BORDER_REPLICATE,
+    'constant': cv2.BORDER_CONSTANT,
+    'reflect':  cv2.BORDER_REFLECT,
+    'mirror':   cv2.BORDER_REFLECT_101,
+}
+fill_modes = [*fill_mode_borders, 'wrap']
 
 
 def apply_affine_transform(x, theta=0, tx=0, ty=0, zx=1, zy=1,
                            fill_mode='nearest', cval=0.):
     """Applies an affine transformation specified by the parameters given.
+    Bilinear interpolation with cv2.warpAffine, or per channel with scipy
+    for the 'wrap' fill mode cv2 has no equivalent of.
     """
-    if scipy is None:
-        raise ImportError('Image transformations require SciPy. '
-                          'Install SciPy.')
+    if fill_mode not in fill_modes:
+        raise ValueError('`fill_mode` should be one of %s. Received: %s'
+                         % (fill_modes, fill_mode))
+
     transform_matrix = None
     if tx != 0 or ty != 0:
         shift_matrix = np.array([[1, 0, tx],
@@ -204,19 +508,49 @@ def apply_affine_transform(x, theta=0, tx=0, ty=0, zx=1, zy=1,
         h, w = x.shape[0], x.shape[1]
         transform_matrix = transform_matrix_offset_center(
             transform_matrix, h, w)
-        x = np.rollaxis(x, 2, 0)
-        final_affine_matrix = transform_matrix[:2, :2]
-        final_offset = transform_matrix[:2, 2]
-
-        channel_images = [scipy.ndimage.interpolation.affine_transform(
-            x_channel,
-            final_affine_matrix,
-            final_offset,
-            order=1,
-            mode=fill_mode,
-            cval=cval) for x_channel in x]
-        x = np.stack(channel_images, axis=0)
-        x = np.rollaxis(x, 0, 3)
+
+        if fill_mode == 'wrap':
+            channel_images = [affine_transform(
+                x[..., c],
+                transform_matrix[:2, :2],
+                transform_matrix[:2, 2],
+                order=1,
+                mode=fill_mode,
+                cval=cval) for c in range(x.shape[2])]
+            return np.stack(channel_images, axis=2)
+
+        # the matrix maps output (row, col) to input (row, col), cv2 wants
+        # the same mapping in (col, row) order
+        cv2_matrix = transform_matrix[[1, 0]][:, [1, 0, 2]]
+
+        # cv2 interpolates 2 channel images less precisely than 1, 3 and 4
+        # channel ones, and float64 less precisely than float32, so warp
+        # in groups of up to 4 channels with any pair warped one by one,
+        # and float64 as float32
+        n_channels = x.shape[2]
+        groups = [(i, min(i + 4, n_channels)) for i in range(0, n_channels, 4)]
+        groups = [g for start, stop in groups
+                  for g in ([(start, start + 1), (start + 1, stop)] if stop - start == 2 else [(start, stop)])]
+
+        dtype = x.dtype
+        warp_input = x.astype(np.float32) if dtype == np.float64 else x
+        channel_groups = [cv2.warpAffine(
+            np.ascontiguousarray(warp_input[..., start:stop]),
+            cv2_matrix,
+            (w, h),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=fill_mode_borders[fill_mode],
+            borderValue=cval) for start, stop in groups]
+        x = np.concatenate([g.reshape(h, w, -1) for g in channel_groups], axis=2).astype(dtype, copy=False)
+
+        if fill_mode == 'constant':
+            # scipy does not interpolate towards cval within half a pixel of
+            # the edge as cv2 does, every sample outside the input is cval
+            rows, cols = np.mgrid[0:h, 0:w]
+            in_rows = transform_matrix[0, 0] * rows + transform_matrix[0, 1] * cols + transform_matrix[0, 2]
+            in_cols = transform_matrix[1, 0] * rows + transform_matrix[1, 1] * cols + transform_matrix[1, 2]
+            outside = (in_rows < 0) | (in_rows > h - 1) | (in_cols < 0) | (in_cols > w - 1)
+            x[outside] = cval
     return x
 
 
@@ -7,6 +7,7 @@ import torch.nn.functional as F
 import torch
 
 from tactile_gym_sim2real.image_transforms import *
+from tactile_gym_sim2real.preprocess_pipeline import PreprocessPipeline
 from tactile_gym.utils.general_utils import load_json_obj
 
 class pix2pix_GAN():
@@ -41,32 +42,33 @@ class pix2pix_GAN():
         # put in eval mode to disable dropout etc
         self.generator.eval()
 
+        # compile the deterministic preprocessing once, reused every control step
+        self.pipeline = PreprocessPipeline(self.params)
+
+    def output_to_image_range(self, gen_sim_images):
+        ''' Undo the sim dataset standardisation so generator outputs are on a 0-1 scale.
+        '''
+        if self.params['stdiz'] == 'dataset':
+            sim_stats = self.params['stdiz_stats']['sim']
+            if self.params['normlz']:
+                gen_sim_images = gen_sim_images * 255.0
+            gen_sim_images = (gen_sim_images * sim_stats['std'] + sim_stats['mean']) / 255.0
+        return gen_sim_images
+
     def gen_sim_image(self, real_image):
 
-        # preprocess/augment image
-        processed_real_image = process_image(
-            real_image, gray=True,
-            bbox=self.params['bbox'], dims=self.params['dims'],
-            stdiz=self.params['stdiz'], normlz=self.params['normlz'],
-            rshift=self.params['rshift'], rzoom=self.params['rzoom'],
-            thresh=self.params['thresh'], add_axis=False,
-            brightlims=self.params['brightlims'], noise_var=self.params['noise_var']
-        )
+        # preprocess image into the pipeline's preallocated buffers
+        processed_real_image = self.pipeline(real_image)
 
         # setup the processed image for plotting
         processed_real_image_plot = (np.clip(processed_real_image, 0, 1)*255).astype(np.uint8) # convert to image format
 
-        # put the channel into first axis because pytorch
-        processed_real_image_pt = np.rollaxis(processed_real_image, 2, 0)
-
-        # add an axis to make a batch
-        processed_real_image_pt = processed_real_image_pt[np.newaxis, ...]
-
-        # convert to torch tensor
-        processed_real_image_pt = torch.from_numpy(processed_real_image_pt).type(self.Tensor)
+        # (1,1,H,W) torch view of the processed image, no copy when already float on cpu
+        processed_real_image_pt = self.pipeline.tensor.type(self.Tensor)
 
         # generate an image
-        gen_sim_image = self.generator(processed_real_image_pt)
+        with torch.no_grad():
+            gen_sim_image = self.output_to_image_range(self.generator(processed_real_image_pt))
 
         # convert to numpy, image format, size expected by rl agent
         gen_sim_image = gen_sim_image[0,0,...].detach().cpu().numpy() # pytorch batch -> numpy image
@@ -76,3 +78,42 @@ class pix2pix_GAN():
             gen_sim_image = cv2.resize(gen_sim_image, tuple(self.rl_image_size), interpolation=cv2.INTER_NEAREST) # resize to RL expected
 
         return gen_sim_image, processed_real_image_plot
+
+    def gen_sim_images(self, real_images):
+        ''' Batched version of gen_sim_image for a stack of (N,H,W,C) raw real
+            images, e.g. when translating recorded frames offline.
+        '''
+
+        # preprocess the whole stack at once
+        processed_real_images = process_images(
+            real_images, gray=True,
+            bbox=self.params['bbox'], dims=self.params['dims'],
+            stdiz=self.params['stdiz'], normlz=self.params['normlz'],
+            rshift=self.params['rshift'], rzoom=self.params['rzoom'],
+            thresh=self.params['thresh'], add_axis=False,
+            brightlims=self.params['brightlims'], noise_var=self.params['noise_var'],
+            fused=self.params.get('fused', False),
+            stdiz_stats=(self.params.get('stdiz_stats') or {}).get('real')
+        )
+
+        # setup the processed images for plotting
+        processed_real_images_plot = (np.clip(processed_real_images, 0, 1)*255).astype(np.uint8)
+
+        # put the channel into second axis because pytorch
+        processed_real_images_pt = np.ascontiguousarray(np.rollaxis(processed_real_images, 3, 1))
+        processed_real_images_pt = torch.from_numpy(processed_real_images_pt).type(self.Tensor)
+
+        # generate the images
+        with torch.no_grad():
+            gen_sim_images = self.output_to_image_range(self.generator(processed_real_images_pt))
+
+        # convert to numpy, image format, size expected by rl agent
+        gen_sim_images = gen_sim_images[:,0,...].cpu().numpy()
+        gen_sim_images = (np.clip(gen_sim_images, 0, 1)*255).astype(np.uint8)
+
+        if self.params['dims'] != self.rl_image_size:
+            gen_sim_images = np.stack([
+                cv2.resize(image, tuple(self.rl_image_size), interpolation=cv2.INTER_NEAREST) for image in gen_sim_images
+            ])
+
+        return gen_sim_images, processed_real_images_plot
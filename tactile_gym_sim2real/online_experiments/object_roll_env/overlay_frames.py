@@ -8,7 +8,7 @@ import cv2
 import itertools
 from skimage.metrics import structural_similarity
 
-from tactile_gym_sim2real.image_transforms import load_video_frames
+from tactile_gym_sim2real.image_transforms import iter_video_frames
 
 
 # load data
@@ -18,22 +18,22 @@ vel_dirs = ['2.5mmps']
 for [size_dir, vel_dir] in list(itertools.product(size_dirs, vel_dirs)):
 
     full_data_dir = os.path.join('collected_data', size_dir, vel_dir)
-    video_frames = load_video_frames(os.path.join(full_data_dir, 'tactile_video.mp4'))
+    video_file = os.path.join(full_data_dir, 'tactile_video.mp4')
     overlay_increment = 2
     offset = 10
     steps_per_goal = 100
     n_goals = 5
 
-    # create block of frames for each goal
-    frame_blocks = []
-    for i in range(n_goals):
+    # create block of frames for each goal, decoding only the strided frames
+    # of one block at a time
+    def goal_frame_block(i):
 
         first_id = (i*steps_per_goal) + offset
         last_id = ((i+1)*steps_per_goal)
 
-        frame_block = video_frames[first_id:last_id:overlay_increment, :, :, :]
+        return list(iter_video_frames(video_file, start=first_id, stop=last_id, step=overlay_increment))
 
-        frame_blocks.append(frame_block)
+    frame_blocks = (goal_frame_block(i) for i in range(n_goals))
 
     # overlay image method
     for i, frame_block in enumerate(frame_blocks):
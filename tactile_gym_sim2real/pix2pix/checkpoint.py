@@ -0,0 +1,99 @@
+import os
+import random
+import numpy as np
+import pandas as pd
+import torch
+
+training_state_filename = 'training_state.pth'
+
+
+def rng_states():
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def reseed_rng(offset):
+    ''' Seeds the rngs from a draw of the current torch rng plus an offset,
+        e.g. a process rank, so processes that share an rng state diverge.
+    '''
+    seed = int(torch.randint(2**31, (1,)).item()) + offset
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def save_training_state(checkpoint_dir, generator, discriminator, optimizer_G, optimizer_D,
+                        epoch, batches_done, loss_df, tracking, all_rng_states=None):
+    ''' Saves everything needed to carry on training after the given epoch:
+        models, optimizer states, counters, rng states, the loss history and
+        the running loss tracking. Written to a temporary file and renamed,
+        so a run killed while saving keeps the previous state.
+
+        In distributed training all_rng_states holds the rng states of every
+        process in rank order, otherwise this process's states are saved.
+    '''
+    state = {
+        'generator': generator.state_dict(),
+        'discriminator': discriminator.state_dict(),
+        'optimizer_G': optimizer_G.state_dict(),
+        'optimizer_D': optimizer_D.state_dict(),
+        'epoch': epoch,
+        'batches_done': batches_done,
+        'loss_df': loss_df.to_dict('list'),
+        'tracking': tracking,
+        'rng_states': all_rng_states if all_rng_states is not None else [rng_states()],
+    }
+
+    state_file = os.path.join(checkpoint_dir, training_state_filename)
+    tmp_file = '{}.{}.tmp'.format(state_file, os.getpid())
+    torch.save(state, tmp_file)
+    os.replace(tmp_file, state_file)
+
+
+def load_training_state(checkpoint_dir, generator, discriminator, optimizer_G, optimizer_D, rank=0):
+    ''' Restores a saved training state into the models and optimizers and
+        the rng states of the given rank, returns the epoch it was saved
+        after, the batch count, the loss history and the running loss
+        tracking.
+    '''
+    # holds the rng states and loss history as well as tensors, loaded to
+    # the cpu as rng states must be, load_state_dict moves the rest over
+    state = torch.load(os.path.join(checkpoint_dir, training_state_filename),
+                       map_location='cpu', weights_only=False)
+
+    generator.load_state_dict(state['generator'])
+    discriminator.load_state_dict(state['discriminator'])
+    optimizer_G.load_state_dict(state['optimizer_G'])
+    optimizer_D.load_state_dict(state['optimizer_D'])
+
+    saved_rng_states = state['rng_states']
+    if isinstance(saved_rng_states, dict):
+        # saved by a single process before states were kept per rank
+        saved_rng_states = [saved_rng_states]
+    if rank < len(saved_rng_states):
+        set_rng_states(saved_rng_states[rank])
+    else:
+        # more processes than were saved, branch off the main process's states
+        set_rng_states(saved_rng_states[0])
+        reseed_rng(rank)
+
+    loss_df = pd.DataFrame(state['loss_df'])
+    return state['epoch'], state['batches_done'], loss_df, state['tracking']
+
+
+def has_training_state(checkpoint_dir):
+    return os.path.isfile(os.path.join(checkpoint_dir, training_state_filename))
@@ -0,0 +1,72 @@
+import contextlib
+import torch
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    ''' Sets the torch thread pools, call before any parallel torch work as
+        the inter-op pool can't be resized once it has started.
+    '''
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            print('Inter-op threads already started, keeping {}'.format(torch.get_num_interop_threads()))
+
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def bf16_supported(cuda=False):
+    ''' True if bfloat16 matmuls/convs are native on the device rather than
+        emulated, emulated bf16 on cpu is slower than float32.
+    '''
+    if cuda:
+        return torch.cuda.is_bf16_supported()
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class PerfMode():
+    ''' Training speed options for pix2pix.py, models are converted in place
+        so their state_dict keys match the plain models.
+
+        channels_last   NHWC models and inputs, faster oneDNN convolutions
+        bf16            bfloat16 autocast of the forward passes and losses
+        compile         torch.compile of the models
+    '''
+
+    def __init__(self, channels_last=False, bf16=False, compile=False, cuda=False):
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self.compile = compile
+        self.device_type = 'cuda' if cuda else 'cpu'
+
+    @classmethod
+    def from_opt(cls, opt, cuda=False):
+        if not opt.cpu_perf:
+            return cls(cuda=cuda)
+        return cls(channels_last=True, bf16=bf16_supported(cuda), compile=True, cuda=cuda)
+
+    def prepare_model(self, model):
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        if self.compile:
+            model.compile()
+        return model
+
+    def prepare_input(self, images):
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    def autocast(self):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=torch.bfloat16)
+
+    def __str__(self):
+        return 'channels_last: {}, bf16: {}, compile: {}, threads: {} intra-op, {} inter-op'.format(
+            self.channels_last, self.bf16, self.compile, torch.get_num_threads(), torch.get_num_interop_threads())
@@ -0,0 +1,114 @@
+'''
+Dataset level normalisation statistics for the 'dataset' stdiz mode.
+
+Statistics are gathered in one streaming pass over each data dir as a 256 bin
+intensity histogram of the deterministically preprocessed uint8 images, so the
+mean and std are exact and dirs can be combined without revisiting images.
+Each dir keeps a small sidecar json beside targets.csv keyed by the
+preprocessing config, entries are rebuilt when targets.csv changes.
+
+Prebuild the stats for a set of dirs with, e.g.
+    python dataset_stats.py --data_dirs ../data_collection/real/data/edge_2d/shear/csv_train --dims 256 256 --thresh True
+'''
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import cv2
+
+from tactile_gym.utils.general_utils import str2bool
+from tactile_gym_sim2real.image_transforms import process_image
+
+stats_filename = 'normalisation_stats.json'
+
+
+def stats_key(gray=True, bbox=None, dims=None, thresh=False, fused=False):
+    ''' Key for the preprocessing applied before the stats are gathered.
+    '''
+    config = {
+        'gray': bool(gray),
+        'bbox': list(bbox) if bbox is not None else None,
+        'dims': list(dims) if dims is not None else None,
+        'thresh': bool(thresh),
+        'fused': bool(fused) and dims is not None,
+    }
+    return json.dumps(config, sort_keys=True)
+
+
+def compute_dir_histogram(data_dir, gray=True, bbox=None, dims=None, thresh=False, fused=False):
+    ''' Streams over the images in a data dir and returns the intensity
+        histogram of the preprocessed images and the number of images.
+    '''
+    label_df = pd.read_csv(os.path.join(data_dir, 'targets.csv'))
+    image_dir = os.path.join(data_dir, 'images')
+
+    hist = np.zeros(256, dtype=np.int64)
+    for sensor_image in label_df['sensor_image']:
+        image = cv2.imread(os.path.join(image_dir, sensor_image))
+        image = process_image(image, gray=gray, bbox=bbox, dims=dims, thresh=thresh, fused=fused)
+        hist += np.bincount(image.ravel(), minlength=256)
+
+    return hist, len(label_df)
+
+
+def load_dir_histogram(data_dir, rebuild=False, **config):
+    ''' Returns the cached histogram for a data dir and preprocessing config,
+        computing it and updating the sidecar file if missing or stale.
+    '''
+    stats_file = os.path.join(data_dir, stats_filename)
+    targets_mtime = os.path.getmtime(os.path.join(data_dir, 'targets.csv'))
+    key = stats_key(**config)
+
+    all_stats = {}
+    if os.path.isfile(stats_file):
+        with open(stats_file, 'r') as f:
+            all_stats = json.load(f)
+
+    entry = all_stats.get(key)
+    if rebuild or entry is None or entry['targets_mtime'] != targets_mtime:
+        hist, n_images = compute_dir_histogram(data_dir, **config)
+        entry = {'n_images': n_images, 'targets_mtime': targets_mtime, 'hist': hist.tolist()}
+        all_stats[key] = entry
+
+        tmp_file = stats_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(all_stats, f)
+        os.replace(tmp_file, stats_file)
+
+    return np.array(entry['hist'], dtype=np.int64)
+
+
+def dataset_stats(data_dirs, rebuild=False, **config):
+    ''' Mean and std of the preprocessed images over all data dirs, as a dict
+        that can be saved with the augmentation params.
+    '''
+    hist = sum(load_dir_histogram(data_dir, rebuild=rebuild, **config) for data_dir in data_dirs)
+
+    values = np.arange(256, dtype=np.float64)
+    n_pixels = hist.sum()
+    mean = (hist * values).sum() / n_pixels
+    std = np.sqrt((hist * (values - mean)**2).sum() / n_pixels)
+
+    return {'mean': float(mean), 'std': float(std)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dirs", type=str, nargs='+', required=True, help="dirs containing targets.csv and images/")
+    parser.add_argument("--bbox", type=int, nargs=4, default=[80, 25, 530, 475], help="crop applied to real images")
+    parser.add_argument("--dims", type=int, nargs=2, default=None, help="resize dims, leave unset for sim images")
+    parser.add_argument("--thresh", type=str2bool, default=False, help="adaptive threshold the images")
+    parser.add_argument("--fused", type=str2bool, default=False, help="use the fused crop/gray/resize")
+    parser.add_argument("--sim", type=str2bool, default=False, help="sim images, no crop/resize/threshold")
+    parser.add_argument("--rebuild", type=str2bool, default=False, help="recompute cached stats")
+    opt = parser.parse_args()
+
+    if opt.sim:
+        config = {}
+    else:
+        config = {'bbox': opt.bbox, 'dims': opt.dims, 'thresh': opt.thresh, 'fused': opt.fused}
+
+    print(dataset_stats(opt.data_dirs, rebuild=opt.rebuild, **config))
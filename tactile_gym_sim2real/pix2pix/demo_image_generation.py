@@ -28,7 +28,8 @@ augmentation_params = {
           'noise_var':   None,  # 0.001,
           'stdiz':       False,
           'normlz':      True,
-          'joint_aug':   False
+          'joint_aug':   False,
+          'fused':       False  # approximate crop/gray/resize in a single remap
           }
 
 add_border = True
@@ -81,7 +82,8 @@ training_generator = DataGenerator(real_data_dirs=training_real_data_dirs,
                                    rzoom=augmentation_params['rzoom'],
                                    brightlims=augmentation_params['brightlims'],
                                    noise_var=augmentation_params['noise_var'],
-                                   joint_aug=augmentation_params['joint_aug'])
+                                   joint_aug=augmentation_params['joint_aug'],
+                                   fused=augmentation_params['fused'])
 
 val_generator = DataGenerator(real_data_dirs=validation_real_data_dirs,
                               sim_data_dirs=validation_sim_data_dirs,
@@ -93,7 +95,8 @@ val_generator = DataGenerator(real_data_dirs=validation_real_data_dirs,
                               rzoom=None,
                               brightlims=None,
                               noise_var=None,
-                              joint_aug=False)
+                              joint_aug=False,
+                              fused=augmentation_params['fused'])
 
 training_loader = torch.utils.data.DataLoader(training_generator,
                                               batch_size=opt.batch_size,
@@ -0,0 +1,119 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed():
+    ''' Joins the process group set up by torchrun with the gloo backend,
+        returns the rank, world size and number of processes on this machine.
+    '''
+    dist.init_process_group(backend='gloo')
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+    return dist.get_rank(), dist.get_world_size(), local_world_size
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    ''' The main process runs the block first, e.g. to prepare files on disk,
+        then the others run it and find the work done.
+    '''
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def broadcast_model(model, src=0):
+    ''' Copies the parameters and buffers (e.g. spectral norm vectors) of the
+        src process's model to all others, so every process starts equal.
+    '''
+    if not is_distributed():
+        return
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def average_gradients(model):
+    ''' All-reduces the gradients of a model in a single flat buffer, leaving
+        every process with the mean gradient over all processes.
+    '''
+    if not is_distributed():
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat_grads = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat_grads)
+    flat_grads /= get_world_size()
+    for grad, reduced in zip(grads, _unflatten_dense_tensors(flat_grads, grads)):
+        grad.copy_(reduced)
+
+
+def average_values(values):
+    ''' Mean over all processes of a 1d array of floats.
+    '''
+    if not is_distributed():
+        return values
+    tensor = torch.as_tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return (tensor / get_world_size()).numpy()
+
+
+def broadcast_values(values, src=0):
+    ''' The src process's 1d array of floats, on every process.
+    '''
+    if not is_distributed():
+        return values
+    tensor = torch.as_tensor(values, dtype=torch.float64)
+    dist.broadcast(tensor, src)
+    return tensor.numpy()
+
+
+def broadcast_object(obj, src=0):
+    ''' The src process's picklable object, on every process.
+    '''
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def gather_objects(obj, dst=0):
+    ''' List of a picklable object from every process in rank order on the
+        dst process, None on the others.
+    '''
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size() if get_rank() == dst else None
+    dist.gather_object(obj, objects, dst)
+    return objects
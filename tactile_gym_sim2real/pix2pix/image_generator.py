@@ -1,17 +1,62 @@
 import numpy as np
 import os
+import copy
+import json
 import cv2
 import pandas as pd
 import torch
+from torch.utils.data import default_collate
+from concurrent.futures import ThreadPoolExecutor
 
-from tactile_gym_sim2real.image_transforms import process_image
+from tactile_gym_sim2real.image_transforms import process_image, process_images
+from tactile_gym_sim2real.batch_augmentation import NoiseBank
+from tactile_gym_sim2real.preprocess_cache import PreprocessCache, deterministic_prefix
+from tactile_gym_sim2real.shared_image_cache import SharedImageCache
+from tactile_gym_sim2real.pix2pix.pair_index import load_pair_index
+
+def normalise_batch(images, stdiz=False, normlz=False, stats=None):
+    ''' Applies the stdiz/normlz stages of process_image to a (B,C,H,W) batch
+        of uint8 images from a DataGenerator with uint8_output set, ideally
+        after moving the batch to the training device. stats holds the dataset
+        mean and std for the images' domain when stdiz is 'dataset'.
+
+        Matches the float path exactly, except with joint_aug where the float
+        path shifts normalised images and the uint8 path shifts and rounds
+        before normalising, so pixels differ by up to half a grey level.
+    '''
+    images = images.float()
+
+    if stdiz == 'dataset':
+        # standardise with fixed dataset constants
+        images = (images - stats['mean']) / stats['std']
+
+    elif stdiz:
+        # standardise on a per frame basis
+        mean = images.mean(dim=(2,3), keepdim=True)
+        std = torch.sqrt(((images - mean)**2).mean(dim=(2,3), keepdim=True))
+        images = (images - mean) / std
+
+    if normlz:
+        images = images / 255.0
+
+    return images
+
+def collate_batch(batch):
+    ''' collate_fn for loaders over a DataGenerator with batched set, where
+        each fetch already returns a dict of (B,C,H,W) tensors.
+    '''
+    if isinstance(batch, dict):
+        return batch
+    return default_collate(batch)
 
 class DataGenerator(torch.utils.data.Dataset):
 
     def __init__(self, real_data_dirs, sim_data_dirs,
                  dim=(100,100), stdiz=False, normlz=False, thresh=None,
                  rshift=None, rzoom=None, brightlims=None, noise_var=None,
-                 joint_aug=False):
+                 joint_aug=False, fused=False, uint8_output=False, noise_bank_size=None,
+                 stdiz_stats=None, cache_dir=None, batched=False, read_threads=0,
+                 shared_cache_mb=None):
 
         # check if data dirs are lists
         assert isinstance(real_data_dirs, list), "Real data dirs should be a list!"
@@ -27,47 +72,146 @@ class DataGenerator(torch.utils.data.Dataset):
         self._brightlims = brightlims
         self._noise_var = noise_var
         self._joint_aug = joint_aug
+        self._fused = fused
+
+        # dataset mean/std per domain, {'real': {...}, 'sim': {...}}, for stdiz='dataset'
+        if stdiz == 'dataset' and stdiz_stats is None:
+            raise ValueError("stdiz='dataset' needs stdiz_stats, see pix2pix/dataset_stats.py")
+        stdiz_stats = stdiz_stats if stdiz_stats is not None else {}
+        self._real_stats = stdiz_stats.get('real')
+        self._sim_stats = stdiz_stats.get('sim')
+
+        # return uint8 images and leave stdiz/normlz to normalise_batch, so
+        # workers send a quarter of the bytes back to the main process. With
+        # joint_aug this moves the shared shift before normalisation, per
+        # image stdiz would then take its mean and std over the shifted image
+        self._uint8_output = uint8_output
+        if uint8_output:
+            if joint_aug and stdiz is True:
+                raise ValueError("uint8_output can't defer per image stdiz with joint_aug, "
+                                 "the shift would change each image's mean and std")
+            self._stdiz, self._normlz = False, False
+
+        # fetch whole batches in __getitems__, needs collate_fn=collate_batch
+        self._batched = batched
+        self._read_threads = read_threads
+        self._read_pool, self._read_pool_pid = None, None
+
+        # pre-generated noise shared (copy on write) by the loader workers
+        self._noise_bank = None
+        if noise_var is not None and noise_bank_size is not None:
+            self._noise_bank = NoiseBank((dim[1], dim[0], 1), size=noise_bank_size)
+
+        # preprocessing that turns raw images into (H,W,1) gray images at dims
+        self._real_prep = {'gray': True, 'bbox': self.bbox, 'dims': self.dim, 'fused': self._fused}
+        self._sim_prep = {'gray': True, 'bbox': None, 'dims': None}
+
+        # with either cache the deterministic part of the preprocessing runs
+        # in load_pair and is cached, so only the random augmentations run
+        # every epoch
+        self._real_prefix, self._sim_prefix = None, None
+        if cache_dir is not None or shared_cache_mb is not None:
+            self._real_prefix = deterministic_prefix({'bbox': self.bbox, 'dims': self.dim, 'fused': fused, 'thresh': thresh,
+                                                      'rshift': rshift, 'rzoom': rzoom, 'joint_aug': joint_aug})
+            self._sim_prefix = deterministic_prefix({}, real=False)
+            self._real_prep = {'gray': False, 'bbox': None, 'dims': None}
+            self._sim_prep = {'gray': False, 'bbox': None, 'dims': None}
+            if self._real_prefix['thresh']:
+                self._thresh = False
+
+        # on disk cache
+        self._real_cache, self._sim_cache = None, None
+        if cache_dir is not None:
+            self._real_cache = PreprocessCache(cache_dir, self._real_prefix)
+            self._sim_cache = PreprocessCache(cache_dir, self._sim_prefix)
+
+        # index the real/sim pairs, only arrays are kept so the index is cheap
+        # to pickle into loader workers and O(1) to look up
+        assert len(real_data_dirs) == len(sim_data_dirs), "Real and sim data dirs should match up!"
+        self._real_image_dirs = [os.path.join(data_dir, 'images') for data_dir in real_data_dirs]
+        self._sim_image_dirs = [os.path.join(data_dir, 'images') for data_dir in sim_data_dirs]
+        self._dir_ids, self._rows, self._image_names = self.load_pairs(real_data_dirs, sim_data_dirs)
+        self._sample_ids = np.arange(len(self._image_names), dtype=np.int32)
 
-        # load csv file
-        self.real_label_df = self.load_data_dirs(real_data_dirs)
-        self.sim_label_df  = self.load_data_dirs(sim_data_dirs)
+        # in memory cache of the real and sim images shared by all loader workers
+        self._shared_cache = None
+        if shared_cache_mb is not None:
+            self._shared_cache = SharedImageCache.from_megabytes(len(self), (2, self.dim[1], self.dim[0]), shared_cache_mb)
 
-    def load_data_dirs(self, data_dirs):
+    def load_pairs(self, real_data_dirs, sim_data_dirs):
+        'Returns the dir pair id, row in the pair index and image file name of each sample'
 
-        # add collumn for which dir data is stored in
-        df_list = []
-        for data_dir in data_dirs:
-            df = pd.read_csv(os.path.join(data_dir, 'targets.csv'))
-            df['image_dir'] = os.path.join(data_dir, 'images')
-            df_list.append(df)
+        dir_ids, rows, image_names = [], [], []
+        for i, (real_data_dir, sim_data_dir) in enumerate(zip(real_data_dirs, sim_data_dirs)):
+            pair_index = load_pair_index(real_data_dir, sim_data_dir)
+            n_pairs = len(pair_index['image_names'])
+            dir_ids.append(np.full(n_pairs, i, dtype=np.int32))
+            rows.append(np.arange(n_pairs, dtype=np.int32))
+            image_names.append(pair_index['image_names'])
 
-        # concat all df
-        full_df = pd.concat(df_list)
-        return full_df
+        return np.concatenate(dir_ids), np.concatenate(rows), np.concatenate(image_names)
+
+    def subset(self, indices):
+        ''' Generator over a subset of the pairs, given as indices or a boolean
+            mask into this generator, sharing everything but the index arrays.
+        '''
+        generator = copy.copy(self)
+        generator._dir_ids = self._dir_ids[indices]
+        generator._rows = self._rows[indices]
+        generator._image_names = self._image_names[indices]
+        generator._sample_ids = self._sample_ids[indices]
+        return generator
 
     def __len__(self):
         'Denotes the number of batches per epoch'
-        return int(np.floor(len(self.real_label_df)))
+        return len(self._image_names)
+
+    def load_pair(self, index):
+        'Load the raw real and sim images for a sample'
+        dir_id, image_name = self._dir_ids[index], self._image_names[index]
+        real_image_filename = os.path.join(self._real_image_dirs[dir_id], image_name)
+        sim_image_filename  = os.path.join(self._sim_image_dirs[dir_id], image_name)
+
+        if self._real_prefix is None:
+            raw_real_image = cv2.imread(real_image_filename)
+            raw_sim_image = cv2.imread(sim_image_filename)
+            return raw_real_image, raw_sim_image
+
+        sample_id = self._sample_ids[index]
+        if self._shared_cache is not None:
+            images = self._shared_cache.get(sample_id)
+            if images is not None:
+                return images[0, ..., np.newaxis], images[1, ..., np.newaxis]
+
+        if self._real_cache is not None:
+            real_image, sim_image = self._real_cache(real_image_filename), self._sim_cache(sim_image_filename)
+        else:
+            real_image = process_image(cv2.imread(real_image_filename), **self._real_prefix)
+            sim_image = process_image(cv2.imread(sim_image_filename), **self._sim_prefix)
+
+        # sim images not at dims are never cached
+        if self._shared_cache is not None and sim_image.shape == real_image.shape:
+            self._shared_cache.put(sample_id, np.stack([real_image[..., 0], sim_image[..., 0]]))
+
+        return real_image, sim_image
 
     def __getitem__(self, index):
         'Generate one batch of data'
 
         # Generate data
-        real_image_filename = os.path.join(self.real_label_df.iloc[index]['image_dir'], self.real_label_df.iloc[index]['sensor_image'])
-        sim_image_filename  = os.path.join(self.sim_label_df.iloc[index]['image_dir'], self.sim_label_df.iloc[index]['sensor_image'])
-
-        raw_real_image = cv2.imread(real_image_filename)
-        raw_sim_image = cv2.imread(sim_image_filename)
+        raw_real_image, raw_sim_image = self.load_pair(index)
 
         # preprocess/augment images separetly
         if not self._joint_aug:
-            processed_real_image = process_image(raw_real_image, gray=True, bbox=self.bbox, dims=self.dim, stdiz=self._stdiz, normlz=self._normlz,
+            processed_real_image = process_image(raw_real_image, **self._real_prep, stdiz=self._stdiz, normlz=self._normlz,
                                                  rshift=self._rshift, rzoom=self._rzoom, thresh=self._thresh,
-                                                 add_axis=False, brightlims=self._brightlims, noise_var=self._noise_var)
+                                                 add_axis=False, brightlims=self._brightlims, noise_var=self._noise_var,
+                                                 noise_bank=self._noise_bank, stdiz_stats=self._real_stats)
 
-            processed_sim_image = process_image(raw_sim_image, gray=True, bbox=None, dims=None, stdiz=self._stdiz, normlz=self._normlz,
+            processed_sim_image = process_image(raw_sim_image, **self._sim_prep, stdiz=self._stdiz, normlz=self._normlz,
                                                  rshift=None, rzoom=None, thresh=None,
-                                                 add_axis=False, brightlims=None, noise_var=None)
+                                                 add_axis=False, brightlims=None, noise_var=None,
+                                                 stdiz_stats=self._sim_stats)
 
             # put the channel into first axis because pytorch
             processed_real_image = np.rollaxis(processed_real_image, 2, 0)
@@ -75,13 +219,15 @@ class DataGenerator(torch.utils.data.Dataset):
 
         elif self._joint_aug:
             # apply some processing to the real image only
-            processed_real_image = process_image(raw_real_image, gray=True, bbox=self.bbox, dims=self.dim, stdiz=self._stdiz, normlz=self._normlz,
+            processed_real_image = process_image(raw_real_image, **self._real_prep, stdiz=self._stdiz, normlz=self._normlz,
                                                  rshift=None, rzoom=None, thresh=self._thresh,
-                                                 add_axis=False, brightlims=self._brightlims, noise_var=self._noise_var)
+                                                 add_axis=False, brightlims=self._brightlims, noise_var=self._noise_var,
+                                                 noise_bank=self._noise_bank, stdiz_stats=self._real_stats)
 
-            processed_sim_image = process_image(raw_sim_image, gray=True, bbox=None, dims=None, stdiz=self._stdiz, normlz=self._normlz,
+            processed_sim_image = process_image(raw_sim_image, **self._sim_prep, stdiz=self._stdiz, normlz=self._normlz,
                                                  rshift=None, rzoom=None, thresh=None,
-                                                 add_axis=False, brightlims=None, noise_var=None)
+                                                 add_axis=False, brightlims=None, noise_var=None,
+                                                 stdiz_stats=self._sim_stats)
 
             # stack images to apply the same data augmentations to both
             stacked_image = np.concatenate([processed_real_image, processed_sim_image], axis=2)
@@ -100,3 +246,195 @@ class DataGenerator(torch.utils.data.Dataset):
             processed_sim_image = processed_sim_image[np.newaxis,...]
 
         return {"real": processed_real_image, "sim": processed_sim_image}
+
+    def __getstate__(self):
+        # thread pools can't be pickled, each loader worker starts its own
+        state = self.__dict__.copy()
+        state['_read_pool'], state['_read_pool_pid'] = None, None
+        return state
+
+    def __getitems__(self, indices):
+        'Generate a whole batch of data at once'
+
+        if not self._batched:
+            return [self[index] for index in indices]
+
+        # read the raw images, optionally on a thread pool as decoding releases the gil
+        if self._read_threads > 0:
+            # forked loader workers inherit the pool object but not its threads
+            if self._read_pool is None or self._read_pool_pid != os.getpid():
+                self._read_pool = ThreadPoolExecutor(max_workers=self._read_threads)
+                self._read_pool_pid = os.getpid()
+            pairs = list(self._read_pool.map(self.load_pair, indices))
+        else:
+            pairs = [self.load_pair(index) for index in indices]
+
+        raw_real_images = np.stack([pair[0] for pair in pairs])
+        raw_sim_images = np.stack([pair[1] for pair in pairs])
+
+        # preprocess/augment the stacks, same stages as __getitem__
+        joint_aug = self._joint_aug
+        processed_real_images = process_images(raw_real_images, **self._real_prep, stdiz=self._stdiz, normlz=self._normlz,
+                                               rshift=None if joint_aug else self._rshift, rzoom=None if joint_aug else self._rzoom,
+                                               thresh=self._thresh, add_axis=False,
+                                               brightlims=self._brightlims, noise_var=self._noise_var,
+                                               noise_bank=self._noise_bank, stdiz_stats=self._real_stats)
+
+        processed_sim_images = process_images(raw_sim_images, **self._sim_prep, stdiz=self._stdiz, normlz=self._normlz,
+                                              rshift=None, rzoom=None, thresh=None,
+                                              add_axis=False, brightlims=None, noise_var=None,
+                                              stdiz_stats=self._sim_stats)
+
+        if joint_aug:
+            # stack images to apply the same shift/zoom augs to both
+            stacked_images = np.concatenate([processed_real_images, processed_sim_images], axis=3)
+            augmented_images = process_images(stacked_images, gray=False, rshift=self._rshift, rzoom=self._rzoom)
+            processed_real_images = augmented_images[..., 0:1]
+            processed_sim_images = augmented_images[..., 1:2]
+
+        # (B,H,W,1) -> (B,1,H,W) tensors because pytorch
+        real = torch.from_numpy(np.ascontiguousarray(processed_real_images.transpose(0, 3, 1, 2)))
+        sim = torch.from_numpy(np.ascontiguousarray(processed_sim_images.transpose(0, 3, 1, 2)))
+        return {"real": real, "sim": sim}
+
+
+class PackedDataGenerator(DataGenerator):
+    ''' DataGenerator over dirs written by pix2pix/pack_dataset.py. Samples are
+        served from a copy on write memmap of each images.npy, opened lazily so
+        DataLoader workers map the file themselves and share pages through
+        the OS cache rather than receiving a pickled copy of the array.
+        Takes the same augmentation args as DataGenerator, but not its
+        preprocessing caches, the packed images are already preprocessed.
+    '''
+
+    def __init__(self, packed_dirs, **kwargs):
+        assert isinstance(packed_dirs, list), "Packed dirs should be a list!"
+        if kwargs.get('cache_dir') is not None or kwargs.get('shared_cache_mb') is not None:
+            raise ValueError('PackedDataGenerator does not take cache_dir or shared_cache_mb, '
+                             'packed images are already preprocessed')
+        self.packed_dirs = packed_dirs
+        self._images = None
+        super().__init__(packed_dirs, packed_dirs, **kwargs)
+
+        for packed_dir in packed_dirs:
+            with open(os.path.join(packed_dir, 'pack_info.json'), 'r') as f:
+                pack_info = json.load(f)
+            if tuple(pack_info['dims']) != tuple(self.dim) or pack_info['fused'] != bool(self._fused) \
+                    or list(pack_info['bbox']) != list(self.bbox):
+                raise ValueError('{} was packed with dims {} fused {} bbox {}, expected dims {} fused {} bbox {}'.format(
+                    packed_dir, pack_info['dims'], pack_info['fused'], pack_info['bbox'],
+                    list(self.dim), bool(self._fused), list(self.bbox)))
+
+        # packed images are already gray, cropped and resized
+        self._real_prep = {'gray': False, 'bbox': None, 'dims': None}
+        self._sim_prep = {'gray': False, 'bbox': None, 'dims': None}
+
+    def load_pairs(self, real_data_dirs, sim_data_dirs):
+        # packed dirs are already paired, row i of targets.csv is row i of images.npy
+        dir_ids, rows, image_names = [], [], []
+        for i, packed_dir in enumerate(real_data_dirs):
+            sensor_images = pd.read_csv(os.path.join(packed_dir, 'targets.csv'), usecols=['sensor_image'])['sensor_image']
+            dir_ids.append(np.full(len(sensor_images), i, dtype=np.int32))
+            rows.append(np.arange(len(sensor_images), dtype=np.int32))
+            image_names.append(sensor_images.to_numpy(dtype=str))
+
+        return np.concatenate(dir_ids), np.concatenate(rows), np.concatenate(image_names)
+
+    def __getstate__(self):
+        # never pickle the memmaps, each worker opens its own
+        state = super().__getstate__()
+        state['_images'] = None
+        return state
+
+    def load_pair(self, index):
+        if self._images is None:
+            self._images = [np.load(os.path.join(packed_dir, 'images.npy'), mmap_mode='c') for packed_dir in self.packed_dirs]
+
+        # (H,W,1) views into the memmap
+        pair = self._images[self._dir_ids[index]][self._rows[index]]
+        return pair[0, ..., np.newaxis], pair[1, ..., np.newaxis]
+
+
+class StreamingDataGenerator(torch.utils.data.IterableDataset):
+    ''' Iterable version of DataGenerator that streams samples shard by shard,
+        where a shard is one real/sim data dir pair. Shards are split
+        deterministically across DataLoader workers (each shard is divided into
+        parts when there are more workers than shards) and samples are
+        shuffled through a bounded buffer of indices, so memory stays flat
+        however many dirs are combined. Takes the same augmentation args as
+        DataGenerator, call set_epoch before each epoch to reshuffle.
+    '''
+
+    def __init__(self, real_data_dirs, sim_data_dirs, shuffle=True, shuffle_buffer=1024, seed=0, **kwargs):
+        assert len(real_data_dirs) == len(sim_data_dirs), "Real and sim data dirs should match up!"
+        self.shards = list(zip(real_data_dirs, sim_data_dirs))
+        self._shuffle = shuffle
+        self._shuffle_buffer = shuffle_buffer
+        self._seed = seed
+        self._epoch = 0
+        self._generator_kwargs = kwargs
+        self._len = None
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def __len__(self):
+        if self._len is None:
+            self._len = int(sum(len(load_pair_index(*shard)['image_names']) for shard in self.shards))
+        return self._len
+
+    def worker_parts(self):
+        ''' The (shard, part, n_parts) units streamed by the current worker.
+        '''
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        # same shard order in every worker, so the split is a partition
+        shard_order = np.arange(len(self.shards))
+        if self._shuffle:
+            shard_order = np.random.default_rng((self._seed, self._epoch)).permutation(shard_order)
+
+        n_parts = -(-n_workers // len(self.shards))
+        parts = [(shard, part, n_parts) for shard in shard_order for part in range(n_parts)]
+        return parts[worker_id::n_workers]
+
+    def _worker_seed(self):
+        worker_info = torch.utils.data.get_worker_info()
+        return worker_info.id if worker_info is not None else 0
+
+    def iter_indices(self):
+        ''' Yields (generator, index) for the samples of this worker's shards,
+            building the index of each shard only when it is reached.
+        '''
+        rng = np.random.default_rng((self._seed, self._epoch, self._worker_seed()))
+        for shard, part, n_parts in self.worker_parts():
+            generator = DataGenerator([self.shards[shard][0]], [self.shards[shard][1]], **self._generator_kwargs)
+            indices = np.arange(len(generator))[part::n_parts]
+            if self._shuffle:
+                indices = rng.permutation(indices)
+            for index in indices:
+                yield generator, index
+
+    def __iter__(self):
+        indices = self.iter_indices()
+
+        if not self._shuffle:
+            for generator, index in indices:
+                yield generator[index]
+            return
+
+        # bounded shuffle buffer, holds indices rather than images
+        rng = np.random.default_rng((self._seed, self._epoch, self._worker_seed(), 1))
+        buffer = []
+        for item in indices:
+            if len(buffer) < self._shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            generator, index = buffer[i]
+            buffer[i] = item
+            yield generator[index]
+
+        for i in rng.permutation(len(buffer)):
+            generator, index = buffer[i]
+            yield generator[index]
@@ -0,0 +1,117 @@
+'''
+Packs a paired real/sim data dir into a single contiguous uint8 array for
+PackedDataGenerator, so training reads images from a memmap rather than
+decoding two pngs per sample.
+
+Real images are stored after the deterministic gray -> crop -> resize prefix
+of process_image (everything after that, including thresholding, is applied
+at load time as it follows the random shift/zoom), sim images as gray scale.
+A packed dir holds
+    images.npy      (N,2,H,W) uint8, real then sim image for each sample
+    targets.csv     the real targets of the paired images, row i is sample i
+    pack_info.json  dims, bbox and source dirs used to build the array
+
+Pack a pair of dirs with, e.g.
+    python pack_dataset.py --real_data_dir ../data_collection/real/data/edge_2d/shear/csv_train \
+                           --sim_data_dir ../data_collection/sim/data/edge_2d/shear/256x256/csv_train --dims 256 256
+'''
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import cv2
+
+from tactile_gym.utils.general_utils import str2bool
+from tactile_gym_sim2real.image_transforms import process_image
+from tactile_gym_sim2real.pix2pix.pair_index import load_pair_index
+
+bbox = [80, 25, 530, 475]
+
+
+def packed_dir_name(real_data_dir, dims, fused=False):
+    ''' Default location of the packed version of a real data dir.
+    '''
+    return os.path.join(real_data_dir, 'packed_{}x{}{}'.format(dims[0], dims[1], '_fused' if fused else ''))
+
+
+def is_up_to_date(packed_dir, real_data_dir, sim_data_dir):
+    ''' Packed array exists and is newer than both source targets.csv files.
+    '''
+    images_file = os.path.join(packed_dir, 'images.npy')
+    if not os.path.isfile(images_file) or not os.path.isfile(os.path.join(packed_dir, 'pack_info.json')):
+        return False
+
+    packed_mtime = os.path.getmtime(images_file)
+    return all(
+        packed_mtime >= os.path.getmtime(os.path.join(data_dir, 'targets.csv'))
+        for data_dir in [real_data_dir, sim_data_dir]
+    )
+
+
+def pack_dataset(real_data_dir, sim_data_dir, dims, packed_dir=None, fused=False, overwrite=False):
+    ''' Streams the image pairs into images.npy and writes the index files.
+        Returns the packed dir, skipping the work if it is already up to date.
+    '''
+    dims = tuple(dims)
+    if packed_dir is None:
+        packed_dir = packed_dir_name(real_data_dir, dims, fused)
+
+    if not overwrite and is_up_to_date(packed_dir, real_data_dir, sim_data_dir):
+        return packed_dir
+
+    # only real images with a sim pair are packed
+    pair_index = load_pair_index(real_data_dir, sim_data_dir)
+    real_df = pd.read_csv(os.path.join(real_data_dir, 'targets.csv')).iloc[pair_index['real_rows']]
+
+    os.makedirs(packed_dir, exist_ok=True)
+    images_file = os.path.join(packed_dir, 'images.npy')
+    tmp_file = images_file + '.tmp.npy'
+
+    n_samples = len(real_df)
+    images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(n_samples, 2, dims[1], dims[0]))
+
+    for i, image_name in enumerate(pair_index['image_names']):
+        raw_real_image = cv2.imread(os.path.join(real_data_dir, 'images', image_name))
+        raw_sim_image = cv2.imread(os.path.join(sim_data_dir, 'images', image_name))
+
+        images[i, 0] = process_image(raw_real_image, gray=True, bbox=bbox, dims=dims, fused=fused)[..., 0]
+
+        processed_sim_image = process_image(raw_sim_image, gray=True)[..., 0]
+        if processed_sim_image.shape != images.shape[2:]:
+            raise ValueError('Sim image {} has shape {}, expected {}'.format(image_name, processed_sim_image.shape, images.shape[2:]))
+        images[i, 1] = processed_sim_image
+
+    images.flush()
+    del images
+    os.replace(tmp_file, images_file)
+
+    real_df.to_csv(os.path.join(packed_dir, 'targets.csv'), index=False)
+    with open(os.path.join(packed_dir, 'pack_info.json'), 'w') as f:
+        json.dump({
+            'dims': list(dims),
+            'bbox': bbox,
+            'fused': bool(fused),
+            'n_samples': n_samples,
+            'real_data_dir': real_data_dir,
+            'sim_data_dir': sim_data_dir,
+        }, f, indent=2)
+
+    return packed_dir
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--real_data_dir", type=str, required=True, help="real dir containing targets.csv and images/")
+    parser.add_argument("--sim_data_dir", type=str, required=True, help="matching sim dir containing targets.csv and images/")
+    parser.add_argument("--dims", type=int, nargs=2, default=[256, 256], help="dims to resize the real images to")
+    parser.add_argument("--packed_dir", type=str, default=None, help="output dir, defaults to packed_WxH inside the real dir")
+    parser.add_argument("--fused", type=str2bool, default=False, help="use the fused crop/gray/resize")
+    parser.add_argument("--overwrite", type=str2bool, default=False, help="repack even if up to date")
+    opt = parser.parse_args()
+
+    packed_dir = pack_dataset(opt.real_data_dir, opt.sim_data_dir, opt.dims,
+                              packed_dir=opt.packed_dir, fused=opt.fused, overwrite=opt.overwrite)
+    print('Packed dataset in {}'.format(packed_dir))
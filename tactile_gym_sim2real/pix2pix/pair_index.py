@@ -0,0 +1,66 @@
+'''
+Explicit real/sim pairing for the pix2pix data dirs.
+
+Sim data is collected from the real targets, so a real and a sim image form a
+pair when they share a sensor_image name within the same task/data dir. The
+join is built once per dir pair and cached beside the real targets.csv, then
+reused until either targets.csv changes.
+'''
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def pair_index_file(real_data_dir, sim_data_dir):
+    sim_key = hashlib.sha1(os.path.abspath(sim_data_dir).encode()).hexdigest()[:12]
+    return os.path.join(real_data_dir, 'pair_index_{}.npz'.format(sim_key))
+
+
+def build_pair_index(real_data_dir, sim_data_dir):
+    ''' Joins the real and sim targets on sensor_image, returns the row of each
+        pair in the real and sim targets.csv and the shared image name, in
+        real targets order.
+    '''
+    real_df = pd.read_csv(os.path.join(real_data_dir, 'targets.csv'), usecols=['sensor_image'])
+    sim_df = pd.read_csv(os.path.join(sim_data_dir, 'targets.csv'), usecols=['sensor_image'])
+
+    pairs = pd.merge(
+        real_df.reset_index().rename(columns={'index': 'real_row'}),
+        sim_df.reset_index().rename(columns={'index': 'sim_row'}),
+        on='sensor_image', how='inner', validate='one_to_one',
+    ).sort_values('real_row')
+
+    if len(pairs) < len(real_df):
+        print('{} of {} real images in {} have no sim pair in {}'.format(
+            len(real_df) - len(pairs), len(real_df), real_data_dir, sim_data_dir))
+
+    return {
+        'real_rows': pairs['real_row'].to_numpy(dtype=np.int32),
+        'sim_rows': pairs['sim_row'].to_numpy(dtype=np.int32),
+        'image_names': pairs['sensor_image'].to_numpy(dtype=str),
+    }
+
+
+def load_pair_index(real_data_dir, sim_data_dir, rebuild=False):
+    ''' Cached build_pair_index, rebuilt when either targets.csv is modified.
+    '''
+    index_file = pair_index_file(real_data_dir, sim_data_dir)
+    mtimes = np.array([
+        os.path.getmtime(os.path.join(real_data_dir, 'targets.csv')),
+        os.path.getmtime(os.path.join(sim_data_dir, 'targets.csv')),
+    ])
+
+    if not rebuild and os.path.isfile(index_file):
+        with np.load(index_file) as cached:
+            if np.array_equal(cached['mtimes'], mtimes):
+                return {key: cached[key] for key in ['real_rows', 'sim_rows', 'image_names']}
+
+    pair_index = build_pair_index(real_data_dir, sim_data_dir)
+
+    tmp_file = '{}.{}.tmp.npz'.format(index_file[:-4], os.getpid())
+    np.savez(tmp_file, mtimes=mtimes, **pair_index)
+    os.replace(tmp_file, index_file)
+
+    return pair_index
@@ -13,7 +13,18 @@ from torch.utils.data import DataLoader
 from torch.autograd import Variable
 
 from tactile_gym.utils.general_utils import str2bool, save_json_obj, check_dir
-from tactile_gym_sim2real.pix2pix.image_generator import DataGenerator
+from tactile_gym_sim2real.pix2pix.image_generator import DataGenerator, PackedDataGenerator, StreamingDataGenerator, normalise_batch, collate_batch
+from tactile_gym_sim2real.pix2pix.threaded_loader import ThreadedDataLoader
+from tactile_gym_sim2real.pix2pix.cpu_perf import PerfMode, configure_threads
+from tactile_gym_sim2real.worker_utils import available_cores
+from tactile_gym_sim2real.pix2pix.checkpoint import save_training_state, load_training_state, has_training_state, rng_states
+from tactile_gym_sim2real.pix2pix.distributed import init_distributed, cleanup_distributed, is_distributed, is_main_process, \
+    get_rank, get_world_size, main_process_first, broadcast_model, average_gradients, average_values, broadcast_values, \
+    broadcast_object, gather_objects
+from tactile_gym_sim2real.pix2pix.validation import Validator, is_best_epoch
+from tactile_gym_sim2real.pix2pix.step_profiler import StepProfiler
+from tactile_gym_sim2real.pix2pix.pack_dataset import pack_dataset
+from tactile_gym_sim2real.pix2pix.dataset_stats import dataset_stats
 from tactile_gym_sim2real.pix2pix.plot_tools import plot_dataframe
 
 def main(opt, augmentation_params, weights, task_dirs, data_dirs):
@@ -38,17 +49,42 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
     image_dir = os.path.join(save_dir_name, 'images')
     checkpoint_dir = os.path.join(save_dir_name, 'checkpoints')
 
-    # check save dir exists
-    check_dir(save_dir_name)
-
-    # make the dirs
-    os.makedirs(image_dir, exist_ok=True)
-    os.makedirs(checkpoint_dir, exist_ok=True)
-
-    # save params
-    save_json_obj(augmentation_params, os.path.join(save_dir_name, 'augmentation_params'))
-    save_json_obj(weights, os.path.join(save_dir_name, 'weights'))
-    save_json_obj(vars(opt), os.path.join(save_dir_name, 'training_params'))
+    # carry on from the latest training state if there is one, as the main
+    # process finds it so every process resumes or none do
+    resume = broadcast_object(opt.resume and has_training_state(checkpoint_dir))
+    if resume and not has_training_state(checkpoint_dir):
+        raise RuntimeError('Process {} has no training state in {} to resume from, '
+                           'the save dir must be shared or copied to every node'.format(get_rank(), checkpoint_dir))
+
+    # in distributed training the main process sets up the save dir and
+    # writes the cached data files, the others then read them
+    with main_process_first():
+
+        # check save dir exists
+        if is_main_process() and not resume and opt.epoch == 0:
+            check_dir(save_dir_name)
+
+        # make the dirs
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # dataset standardisation constants from the training data, saved with the
+        # params so inference applies exactly the same constants
+        augmentation_params = dict(augmentation_params)
+        if augmentation_params['stdiz'] == 'dataset':
+            augmentation_params['stdiz_stats'] = {
+                'real': dataset_stats(training_real_data_dirs, bbox=[80,25,530,475], dims=augmentation_params['dims'],
+                                      thresh=augmentation_params['thresh'], fused=augmentation_params['fused']),
+                'sim':  dataset_stats(training_sim_data_dirs),
+            }
+
+        # save params
+        if is_main_process():
+            save_json_obj(augmentation_params, os.path.join(save_dir_name, 'augmentation_params'))
+            save_json_obj(weights, os.path.join(save_dir_name, 'weights'))
+            save_json_obj(vars(opt), os.path.join(save_dir_name, 'training_params'))
+
+    stdiz_stats = augmentation_params.get('stdiz_stats')
 
     # enable gpu
     cuda = True if torch.cuda.is_available() else False
@@ -70,10 +106,17 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
         criterion_GAN.cuda()
         criterion_pixelwise.cuda()
 
-    if opt.epoch != 0:
-        # Load pretrained models
+    # memory format, autocast and compilation options for faster training
+    perf = PerfMode.from_opt(opt, cuda=cuda)
+    if is_main_process():
+        print('Training perf mode: {}'.format(perf))
+    generator = perf.prepare_model(generator)
+    discriminator = perf.prepare_model(discriminator)
+
+    if opt.epoch != 0 and not resume:
+        # Load pretrained models, optimizer and rng states start afresh
         generator.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'final_generator.pth')))
-        discriminator.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'final_discriminator_{}.pth')))
+        discriminator.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'final_discriminator.pth')))
     else:
         # Initialize weights
         generator.apply(weights_init_normal)
@@ -83,52 +126,128 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
     optimizer_G = torch.optim.Adam(generator.parameters(),     lr=opt.lr, betas=(opt.b1, opt.b2))
     optimizer_D = torch.optim.Adam(discriminator.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 
-    # Configure dataloaders
-    training_generator = DataGenerator(real_data_dirs=training_real_data_dirs,
-                                       sim_data_dirs=training_sim_data_dirs,
-                                       dim=augmentation_params['dims'],
-                                       stdiz=augmentation_params['stdiz'],
-                                       normlz=augmentation_params['normlz'],
-                                       thresh=augmentation_params['thresh'],
-                                       rshift=augmentation_params['rshift'],
-                                       rzoom=augmentation_params['rzoom'],
-                                       brightlims=augmentation_params['brightlims'],
-                                       noise_var=augmentation_params['noise_var'],
-                                       joint_aug=augmentation_params['joint_aug'])
-
-    val_generator = DataGenerator(real_data_dirs=validation_real_data_dirs,
-                                  sim_data_dirs=validation_sim_data_dirs,
-                                  dim=augmentation_params['dims'],
-                                  stdiz=augmentation_params['stdiz'],
-                                  normlz=augmentation_params['normlz'],
-                                  thresh=augmentation_params['thresh'],
-                                  rshift=None,
-                                  rzoom=None,
-                                  brightlims=None,
-                                  noise_var=None,
-                                  joint_aug=False)
-
-    training_loader = torch.utils.data.DataLoader(training_generator,
-                                                  batch_size=opt.batch_size,
-                                                  shuffle=opt.shuffle,
-                                                  num_workers=opt.n_cpu)
-
-    val_loader = torch.utils.data.DataLoader(val_generator,
+    # Configure dataloaders, optionally from packed copies of the data dirs
+    if opt.packed_data:
+        generator_class = PackedDataGenerator
+        with main_process_first():
+            training_dirs = {'packed_dirs': [
+                pack_dataset(real_dir, sim_dir, augmentation_params['dims'], fused=augmentation_params['fused'])
+                for real_dir, sim_dir in zip(training_real_data_dirs, training_sim_data_dirs)
+            ]}
+            validation_dirs = {'packed_dirs': [
+                pack_dataset(real_dir, sim_dir, augmentation_params['dims'], fused=augmentation_params['fused'])
+                for real_dir, sim_dir in zip(validation_real_data_dirs, validation_sim_data_dirs)
+            ]}
+    else:
+        generator_class = DataGenerator
+        training_dirs = {'real_data_dirs': training_real_data_dirs, 'sim_data_dirs': training_sim_data_dirs}
+        validation_dirs = {'real_data_dirs': validation_real_data_dirs, 'sim_data_dirs': validation_sim_data_dirs}
+
+    # stream the training data shard by shard instead of indexing it all up front
+    training_generator_class = generator_class
+    if opt.streaming:
+        training_generator_class = StreamingDataGenerator
+        training_dirs = dict(training_dirs, shuffle=opt.shuffle, shuffle_buffer=opt.shuffle_buffer)
+
+    # packed data is already past the expensive deterministic preprocessing
+    cache_kwargs = {'cache_dir': opt.preprocess_cache} if opt.preprocess_cache is not None and not opt.packed_data else {}
+    training_cache_kwargs = dict(cache_kwargs)
+    if opt.shared_cache_mb is not None and not (opt.packed_data or opt.streaming):
+        training_cache_kwargs['shared_cache_mb'] = opt.shared_cache_mb
+
+    training_generator = training_generator_class(**training_dirs,
+                                                  dim=augmentation_params['dims'],
+                                                  stdiz=augmentation_params['stdiz'],
+                                                  normlz=augmentation_params['normlz'],
+                                                  thresh=augmentation_params['thresh'],
+                                                  rshift=augmentation_params['rshift'],
+                                                  rzoom=augmentation_params['rzoom'],
+                                                  brightlims=augmentation_params['brightlims'],
+                                                  noise_var=augmentation_params['noise_var'],
+                                                  joint_aug=augmentation_params['joint_aug'],
+                                                  fused=augmentation_params['fused'],
+                                                  uint8_output=opt.uint8_data,
+                                                  noise_bank_size=opt.noise_bank_size,
+                                                  stdiz_stats=stdiz_stats,
+                                                  batched=opt.batched_loading,
+                                                  read_threads=opt.read_threads,
+                                                  **training_cache_kwargs)
+
+    val_generator = generator_class(**validation_dirs,
+                                    dim=augmentation_params['dims'],
+                                    stdiz=augmentation_params['stdiz'],
+                                    normlz=augmentation_params['normlz'],
+                                    thresh=augmentation_params['thresh'],
+                                    rshift=None,
+                                    rzoom=None,
+                                    brightlims=None,
+                                    noise_var=None,
+                                    joint_aug=False,
+                                    fused=augmentation_params['fused'],
+                                    uint8_output=opt.uint8_data,
+                                    stdiz_stats=stdiz_stats,
+                                    batched=opt.batched_loading,
+                                    read_threads=opt.read_threads,
+                                    **cache_kwargs)
+
+    # each process trains on its own part of the training data
+    training_sampler = None
+    if is_distributed():
+        training_sampler = torch.utils.data.distributed.DistributedSampler(training_generator, shuffle=opt.shuffle)
+
+    if opt.loader == 'thread':
+        # build batches on threads in this process, cv2 releases the gil
+        training_loader = ThreadedDataLoader(training_generator,
                                              batch_size=opt.batch_size,
                                              shuffle=opt.shuffle,
-                                             num_workers=opt.n_cpu)
+                                             n_threads=opt.loader_threads,
+                                             prefetch=opt.prefetch_batches,
+                                             sampler=training_sampler)
+
+        val_loader = ThreadedDataLoader(val_generator,
+                                        batch_size=opt.batch_size,
+                                        shuffle=opt.shuffle,
+                                        n_threads=opt.loader_threads,
+                                        prefetch=opt.prefetch_batches)
+    else:
+        training_loader = torch.utils.data.DataLoader(training_generator,
+                                                      batch_size=opt.batch_size,
+                                                      shuffle=opt.shuffle and not opt.streaming and training_sampler is None,
+                                                      sampler=training_sampler,
+                                                      num_workers=opt.n_cpu,
+                                                      prefetch_factor=opt.prefetch_batches if opt.n_cpu > 0 else None,
+                                                      collate_fn=collate_batch)
+
+        # keep the val workers between validation passes
+        val_loader = torch.utils.data.DataLoader(val_generator,
+                                                 batch_size=opt.batch_size,
+                                                 shuffle=opt.shuffle,
+                                                 num_workers=opt.n_cpu,
+                                                 prefetch_factor=opt.prefetch_batches if opt.n_cpu > 0 else None,
+                                                 persistent_workers=opt.n_cpu > 0,
+                                                 collate_fn=collate_batch)
 
 
     # Tensor type
     Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 
+    def model_input(images, domain):
+        """Converts a batch from the loaders to model input"""
+        if opt.uint8_data:
+            # transfer as uint8 then apply the deferred normalisation on the device
+            images = images.cuda() if cuda else images
+            images = normalise_batch(images, stdiz=augmentation_params['stdiz'], normlz=augmentation_params['normlz'],
+                                     stats=stdiz_stats[domain] if stdiz_stats is not None else None)
+        return Variable(perf.prepare_input(images.type(Tensor)))
+
+    # validation batches for the sample grids and val metrics
+    validator = Validator(val_loader, model_input, autocast=perf.autocast)
+
     n_save_images = np.min([opt.batch_size, 8])
     def sample_images(batches_done):
         """Saves a generated sample from the validation set"""
-        imgs = next(iter(val_loader))
-        real_imgs = Variable(imgs["real"].type(Tensor))
-        sim_imgs = Variable(imgs["sim"].type(Tensor))
-        gen_sim_imgs = torch.clamp(generator(real_imgs), 0, 1)
+        real_imgs, sim_imgs, gen_sim_imgs = validator.generate(generator, validator.sample_batch())
+        gen_sim_imgs = torch.clamp(gen_sim_imgs, 0, 1)
         img_sample = torch.cat((real_imgs.data[:n_save_images,:,:,:],
                                 gen_sim_imgs.data[:n_save_images,:,:,:],
                                 sim_imgs.data[:n_save_images,:,:,:]), -2)
@@ -138,28 +257,76 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
     # -------------------------------- Training --------------------------------
     # ----------
 
-    # save an image with no training
-    sample_images('no_training')
-
-    # create dataframe for storing tracked data
-    loss_df = pd.DataFrame(columns=['Epoch', 'D_Loss', 'Real_Loss', 'Fake_Loss', 'G_Loss', 'GAN_Loss', 'Pixel_Loss'])
+    # create dataframe for storing tracked data, running training losses then val metrics
+    train_loss_columns = ['D_Loss', 'Real_Loss', 'Fake_Loss', 'G_Loss', 'GAN_Loss', 'Pixel_Loss']
+    val_metric_columns = ['Val_L1', 'Val_SSIM']
+    loss_df = pd.DataFrame(columns=['Epoch', *train_loss_columns, *val_metric_columns])
 
     # initialise tracking vars
-    running_losses = np.zeros(loss_df.shape[1]-1)
+    running_losses = np.zeros(len(train_loss_columns))
     sample_batch_count = 0
     row_id = 0
+    start_epoch = opt.epoch
+
+    if resume:
+        # restore models, optimizers, rng states and tracking after the last saved epoch
+        last_epoch, batches_done, saved_loss_df, tracking = load_training_state(checkpoint_dir, generator, discriminator,
+                                                                                optimizer_G, optimizer_D, rank=get_rank())
+        loss_df = saved_loss_df.reindex(columns=loss_df.columns)
+        running_losses = np.array(tracking['running_losses'])
+        sample_batch_count = tracking['sample_batch_count']
+        row_id = tracking['row_id']
+        start_epoch = last_epoch + 1
+        if broadcast_object(start_epoch) != start_epoch:
+            raise RuntimeError('Process {} resumes from epoch {}, not the epoch the main process resumes from, '
+                               'the training states on the nodes differ'.format(get_rank(), start_epoch))
+        if is_main_process():
+            print('Resuming training from epoch {} ({} batches done)'.format(start_epoch, batches_done))
+    elif is_main_process():
+        # save an image with no training
+        sample_images('no_training')
+
+    # start every process from the main process's models
+    broadcast_model(generator)
+    broadcast_model(discriminator)
+
+    # per step timing of data loading and the training stages
+    profiler = StepProfiler(enabled=opt.profile,
+                            log_file=os.path.join(save_dir_name, 'training_profile.jsonl'),
+                            trace_file=os.path.join(save_dir_name, 'profile_trace.json'),
+                            trace_steps=opt.profile_trace_steps if is_main_process() else None,
+                            cuda=cuda)
+
+    # steps are counted as they run, as with more than one worker a streaming
+    # loader returns a partial batch per worker and runs past its length
+    if not resume:
+        batches_done = start_epoch * len(training_loader)
+    steps_per_epoch = len(training_loader)
+
     prev_time = time.time()
 
-    for epoch in range(opt.epoch, opt.n_epochs+1):
-        for i, batch in enumerate(training_loader):
+    for epoch in range(start_epoch, opt.n_epochs+1):
+        if opt.streaming:
+            training_generator.set_epoch(epoch)
+        if training_sampler is not None:
+            training_sampler.set_epoch(epoch)
+
+        epoch_start_time = time.time()
+        epoch_start_step = batches_done
+        epoch_images = 0
+        profiler.reset()
 
-            # Model inputs
-            tip_images = Variable(batch['real'].type(Tensor))
-            sim_images = Variable(batch['sim'].type(Tensor))
+        for i, batch in enumerate(profiler.batches(training_loader)):
+            profiler.start_step(batches_done)
 
-            # Adversarial ground truths
-            valid = Variable(Tensor(np.ones((tip_images.size(0), *patch))), requires_grad=False)
-            fake = Variable(Tensor(np.zeros((tip_images.size(0), *patch))), requires_grad=False)
+            with profiler.section('inputs'):
+                # Model inputs
+                tip_images = model_input(batch['real'], 'real')
+                sim_images = model_input(batch['sim'], 'sim')
+
+                # Adversarial ground truths
+                valid = Variable(Tensor(np.ones((tip_images.size(0), *patch))), requires_grad=False)
+                fake = Variable(Tensor(np.zeros((tip_images.size(0), *patch))), requires_grad=False)
 
             # ------------------
             #  Train Generators
@@ -167,22 +334,27 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
 
             optimizer_G.zero_grad()
 
-            # GAN loss
-            gen_sim_images = generator(tip_images)
+            with profiler.section('G_forward'), perf.autocast():
+                # GAN loss
+                gen_sim_images = generator(tip_images)
 
-            pred_gen = discriminator(gen_sim_images, tip_images)
+                pred_gen = discriminator(gen_sim_images, tip_images)
 
-            loss_GAN = criterion_GAN(pred_gen, valid)
+                loss_GAN = criterion_GAN(pred_gen, valid)
 
-            # Pixel-wise loss
-            loss_pixel = criterion_pixelwise(gen_sim_images, sim_images)
+                # Pixel-wise loss
+                loss_pixel = criterion_pixelwise(gen_sim_images, sim_images)
 
-            # Total loss
-            loss_G = (weights['W_gan']*loss_GAN) + (weights['W_pixel']*loss_pixel)
+                # Total loss
+                loss_G = (weights['W_gan']*loss_GAN) + (weights['W_pixel']*loss_pixel)
 
-            loss_G.backward()
+            with profiler.section('G_backward'):
+                loss_G.backward()
+            with profiler.section('G_allreduce'):
+                average_gradients(generator)
 
-            optimizer_G.step()
+            with profiler.section('G_optimizer'):
+                optimizer_G.step()
 
             # ---------------------
             #  Train Discriminator
@@ -190,47 +362,52 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
 
             optimizer_D.zero_grad()
 
-            # Real loss
-            pred_real = discriminator(sim_images, tip_images)
-            loss_real = criterion_GAN(pred_real, valid)
+            with profiler.section('D_forward'), perf.autocast():
+                # Real loss
+                pred_real = discriminator(sim_images, tip_images)
+                loss_real = criterion_GAN(pred_real, valid)
 
-            # Fake loss
-            pred_fake = discriminator(gen_sim_images.detach(), tip_images)
-            loss_fake = criterion_GAN(pred_fake, fake)
+                # Fake loss
+                pred_fake = discriminator(gen_sim_images.detach(), tip_images)
+                loss_fake = criterion_GAN(pred_fake, fake)
 
-            # Total loss
-            loss_disc = 0.5 * (loss_real + loss_fake)
-            loss_D = loss_disc
+                # Total loss
+                loss_disc = 0.5 * (loss_real + loss_fake)
+                loss_D = loss_disc
 
-            loss_D.backward()
-            optimizer_D.step()
+            with profiler.section('D_backward'):
+                loss_D.backward()
+            with profiler.section('D_allreduce'):
+                average_gradients(discriminator)
+            with profiler.section('D_optimizer'):
+                optimizer_D.step()
 
             # --------------
             #  Log Progress
             # --------------
 
             # Determine approximate time left
-            batches_done = epoch * len(training_loader) + i
-            batches_left = opt.n_epochs * len(training_loader) - batches_done
+            batches_left = (opt.n_epochs - epoch) * steps_per_epoch - i
             time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
             prev_time = time.time()
 
             # Print log
-            sys.stdout.write(
-                "\r[Epoch {}/{}] [Batch {}/{}] [D_loss: {:.5f}, real_loss: {:.5f}, fake_loss: {:.5f}] [G_loss: {:.5f}, GAN_loss: {:.5f}, pix_loss: {:.5f}] ETA: {}".format(
-                    epoch,
-                    opt.n_epochs,
-                    i,
-                    len(training_loader),
-                    loss_D.item(),
-                    loss_real.item(),
-                    loss_fake.item(),
-                    loss_G.item(),
-                    loss_GAN.item(),
-                    loss_pixel.item(),
-                    time_left,
+            if is_main_process():
+                sys.stdout.write(
+                    "\r[Epoch {}/{}] [Batch {}/{}] [D_loss: {:.5f}, real_loss: {:.5f}, fake_loss: {:.5f}] [G_loss: {:.5f}, GAN_loss: {:.5f}, pix_loss: {:.5f}] ETA: {}".format(
+                        epoch,
+                        opt.n_epochs,
+                        i,
+                        steps_per_epoch,
+                        loss_D.item(),
+                        loss_real.item(),
+                        loss_fake.item(),
+                        loss_G.item(),
+                        loss_GAN.item(),
+                        loss_pixel.item(),
+                        time_left,
+                    )
                 )
-            )
 
             running_losses[0] += loss_D.item()
             running_losses[1] += loss_real.item()
@@ -239,60 +416,97 @@ def main(opt, augmentation_params, weights, task_dirs, data_dirs):
             running_losses[4] += loss_GAN.item()
             running_losses[5] += loss_pixel.item()
             sample_batch_count += 1
+            epoch_images += tip_images.size(0)
+            profiler.end_step(batches_done, tip_images.size(0))
+            batches_done += 1
+
+        # steps this epoch actually took, for the progress and time left
+        steps_per_epoch = batches_done - epoch_start_step
+
+        # step timing summary, per process
+        profiler.end_epoch(epoch, write=is_main_process())
+
+        # training throughput over all processes, to compare perf modes
+        epoch_time = time.time() - epoch_start_time
+        if is_main_process():
+            epoch_images *= get_world_size()
+            print('')
+            print('[Epoch {}] {} images in {:.1f}s, {:.1f} images/sec'.format(
+                epoch, epoch_images, epoch_time, epoch_images / max(epoch_time, 1e-9)))
 
         # If at sample interval save image
         if (epoch % opt.sample_interval == 0) or ((epoch) % opt.n_epochs == 0):
 
-            sample_images('epoch_{}'.format(epoch))
+            # average the running losses over the number of batches done, and
+            # over all processes so every process keeps the same loss history
+            running_losses = average_values(running_losses / sample_batch_count)
 
-            # average the running losses over the number of batches done
-            running_losses = running_losses / sample_batch_count
+            # metrics over the whole val set, shared with the other processes
+            val_metrics = np.zeros(len(val_metric_columns))
+            if is_main_process():
+                val_metrics = validator.evaluate(generator)
+            val_metrics = broadcast_values(val_metrics)
 
             # append to df
-            loss_df.loc[row_id] = [epoch, *running_losses]
+            loss_df.loc[row_id] = [epoch, *running_losses, *val_metrics]
 
-            # print
-            print('')
-            print('')
-            print(loss_df.loc[row_id])
+            # check if this has the lowest validation pixel loss
+            best_model_flag = is_best_epoch(loss_df, row_id)
+
+            if is_main_process():
+                sample_images('epoch_{}'.format(epoch))
+
+                # print
+                print('')
+                print('')
+                print(loss_df.loc[row_id])
 
-            # check if this has the lowest running pixel loss
-            if loss_df.loc[row_id]['Pixel_Loss'] == min(loss_df['Pixel_Loss']):
-                best_model_flag = True
-            else:
-                best_model_flag = False
+                # save the dataframe as csv
+                loss_df.to_csv(os.path.join(save_dir_name, 'training_losses.csv'))
 
-            # save the dataframe as csv
-            loss_df.to_csv(os.path.join(save_dir_name, 'training_losses.csv'))
+                # plot the dataframe
+                plot_dataframe(loss_df, save_file=os.path.join(save_dir_name, 'training_curves.png'))
 
-            # plot the dataframe
-            plot_dataframe(loss_df, save_file=os.path.join(save_dir_name, 'training_curves.png'))
+                # Save latest model checkpoints
+                print('')
+                print('Saving Model {}'.format(epoch))
+                print('')
+                torch.save(generator.state_dict(), os.path.join(checkpoint_dir, 'final_generator.pth'))
+                torch.save(discriminator.state_dict(), os.path.join(checkpoint_dir, 'final_discriminator.pth'))
+
+                # Save best model checkpoints
+                if best_model_flag:
+                    print('Saving Best Model {}'.format(epoch))
+                    print('')
+                    torch.save(generator.state_dict(), os.path.join(checkpoint_dir, 'best_generator.pth'))
+                    torch.save(discriminator.state_dict(), os.path.join(checkpoint_dir, 'best_discriminator.pth'))
 
             # update tracking vars
-            running_losses = np.zeros(loss_df.shape[1]-1)
+            running_losses = np.zeros(len(train_loss_columns))
             sample_batch_count = 0
             row_id += 1
 
-            # Save latest model checkpoints
-            print('')
-            print('Saving Model {}'.format(epoch))
-            print('')
-            torch.save(generator.state_dict(), os.path.join(checkpoint_dir, 'final_generator.pth'))
-            torch.save(discriminator.state_dict(), os.path.join(checkpoint_dir, 'final_discriminator.pth'))
-
-            # Save best model checkpoints
-            if best_model_flag:
-                print('Saving Best Model {}'.format(epoch))
-                print('')
-                torch.save(generator.state_dict(), os.path.join(checkpoint_dir, 'best_generator.pth'))
-                torch.save(discriminator.state_dict(), os.path.join(checkpoint_dir, 'best_discriminator.pth'))
+        # Save the full training state to resume from
+        if (epoch % opt.checkpoint_interval == 0) or (epoch == opt.n_epochs):
+            # every process's rng states, so each carries on its own streams
+            all_rng_states = gather_objects(rng_states())
+            if is_main_process():
+                tracking = {
+                    'running_losses': running_losses.tolist(),
+                    'sample_batch_count': sample_batch_count,
+                    'row_id': row_id,
+                }
+                save_training_state(checkpoint_dir, generator, discriminator, optimizer_G, optimizer_D,
+                                    epoch, batches_done, loss_df, tracking, all_rng_states)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--epoch", type=int, default=0, help="epoch to start training from")
+    parser.add_argument("--epoch", type=int, default=0, help="epoch to start training from, from the final models if there is no training state")
+    parser.add_argument("--resume", type=str2bool, default=True, help="resume from the latest training state in the save dir")
+    parser.add_argument("--checkpoint_interval", type=int, default=1, help="epochs between saves of the full training state")
     parser.add_argument("--n_epochs", type=int, default=250, help="number of epochs of training")
-    parser.add_argument("--batch_size", type=int, default=64, help="size of the batches")
+    parser.add_argument("--batch_size", type=int, default=64, help="size of the batches, per process in distributed training")
     parser.add_argument("--lr", type=float, default=0.0002, help="adam: learning rate")
     parser.add_argument("--b1", type=float, default=0.5, help="adam: decay of first order momentum of gradient")
     parser.add_argument("--b2", type=float, default=0.999, help="adam: decay of first order momentum of gradient")
@@ -301,8 +515,53 @@ if __name__ == '__main__':
     parser.add_argument("--channels", type=int, default=1, help="number of image channels")
     parser.add_argument("--shuffle", type=str2bool, default=True, help="shuffle the generated image data")
     parser.add_argument("--sample_interval", type=int, default=5, help="interval between sampling of images from generators")
+    parser.add_argument("--noise_bank_size", type=int, default=None, help="draw augmentation noise from a pre-generated bank of this many images")
+    parser.add_argument("--uint8_data", type=str2bool, default=False, help="load uint8 images and normalise batches in the training step")
+    parser.add_argument("--packed_data", type=str2bool, default=False, help="pack the data dirs into memmapped arrays and train from those")
+    parser.add_argument("--batched_loading", type=str2bool, default=False, help="load and preprocess each batch as a single stack")
+    parser.add_argument("--read_threads", type=int, default=0, help="threads per loader worker for reading images in batched loading")
+    parser.add_argument("--streaming", type=str2bool, default=False, help="stream training data from each data dir in turn, not with --packed_data")
+    parser.add_argument("--shuffle_buffer", type=int, default=1024, help="samples held for shuffling when streaming")
+    parser.add_argument("--shared_cache_mb", type=int, default=None, help="size of an in memory image cache shared by the loader workers")
+    parser.add_argument("--preprocess_cache", type=str, default=None, help="dir to cache the deterministic image preprocessing in")
+    parser.add_argument("--loader", type=str, default='process', choices=['process', 'thread'], help="build batches in worker processes or on threads, not thread with --streaming")
+    parser.add_argument("--loader_threads", type=int, default=8, help="number of threads building batches with the thread loader")
+    parser.add_argument("--prefetch_batches", type=int, default=2, help="batches prefetched per loader worker or thread")
+    parser.add_argument("--cpu_perf", type=str2bool, default=False, help="channels_last, bf16 autocast where supported and compiled models")
+    parser.add_argument("--intra_op_threads", type=int, default=None, help="torch intra-op threads, with --cpu_perf defaults to the cores not used by the loader")
+    parser.add_argument("--inter_op_threads", type=int, default=None, help="torch inter-op threads, with --cpu_perf defaults to 1")
+    parser.add_argument("--profile", type=str2bool, default=False, help="time the training step stages, logged per epoch to training_profile.jsonl")
+    parser.add_argument("--profile_trace_steps", type=int, nargs=2, default=None, help="first step and number of steps to record a torch.profiler trace of")
+    parser.add_argument("--distributed", type=str2bool, default=False, help="data parallel training over gloo, launch with torchrun")
     opt = parser.parse_args()
 
+    if opt.streaming and opt.packed_data:
+        sys.exit('Streaming is not supported with packed data')
+
+    if opt.streaming and opt.loader == 'thread':
+        sys.exit('Streaming is not supported with the thread loader')
+
+    if opt.streaming and opt.distributed:
+        sys.exit('Streaming is not supported with distributed training')
+
+    # join the other processes, e.g.
+    #   torchrun --nproc_per_node 4 pix2pix.py --distributed true
+    #   torchrun --nnodes 2 --node_rank 0 --master_addr host0 --nproc_per_node 2 pix2pix.py --distributed true
+    local_world_size = 1
+    if opt.distributed:
+        rank, world_size, local_world_size = init_distributed()
+        print('Training process {} of {}'.format(rank, world_size))
+
+    # set the torch thread pools before any torch work starts them, sharing
+    # the cores between the processes on this machine
+    if opt.cpu_perf:
+        loader_cores = opt.loader_threads if opt.loader == 'thread' else opt.n_cpu
+        if opt.intra_op_threads is None:
+            opt.intra_op_threads = max(1, available_cores() // local_world_size - loader_cores)
+        if opt.inter_op_threads is None:
+            opt.inter_op_threads = 1
+    configure_threads(opt.intra_op_threads, opt.inter_op_threads)
+
     # Parameters
     augmentation_params = {
               'dims':        (256, 256),
@@ -311,9 +570,10 @@ if __name__ == '__main__':
               'thresh':      True,
               'brightlims':  None,  # [0.3, 1.0, -50, 50], # alpha limits for contrast, beta limits for brightness
               'noise_var':   None,  # 0.001,
-              'stdiz':       False,
+              'stdiz':       False,  # True per image, 'dataset' for fixed training set constants
               'normlz':      True,
-              'joint_aug':   False
+              'joint_aug':   False,
+              'fused':       False  # approximate crop/gray/resize in a single remap
               }
 
     # weighting for loss functions
@@ -345,3 +605,5 @@ if __name__ == '__main__':
 
     for task_dirs in [['edge_2d'], ['surface_3d']]:
         main(opt, augmentation_params, weights, task_dirs, data_dirs)
+
+    cleanup_distributed()
@@ -0,0 +1,153 @@
+import json
+import time
+import contextlib
+from collections import defaultdict
+import numpy as np
+import torch
+
+
+def queue_depth(loader, loader_iter):
+    ''' Batches ready and waiting in a loader, None if it can't tell.
+    '''
+    if hasattr(loader, 'ready_batches'):
+        return loader.ready_batches()
+    data_queue = getattr(loader_iter, '_data_queue', None)
+    if data_queue is None:
+        return None
+    try:
+        return data_queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues have no qsize on macos
+        return None
+
+
+class StepProfiler():
+    ''' Times the sections of each training step and writes a summary per
+        epoch as a line of json, to tell whether training is waiting on data
+        or on compute.
+
+        Sections are timed with wall clock time, synchronising cuda first so
+        the time falls in the section that queued the work. The data section
+        is the time spent waiting on the loader for a batch, with the depth
+        of the loader's queue of ready batches sampled as each batch arrives.
+
+        A torch.profiler trace can be recorded for a range of global steps.
+    '''
+
+    def __init__(self, enabled=False, log_file=None, trace_file=None, trace_steps=None, cuda=False):
+        self.enabled = enabled
+        self.log_file = log_file
+        self.trace_file = trace_file
+        self.trace_steps = trace_steps
+        self.cuda = cuda
+        self._torch_profiler = None
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(list)
+        self.queue_depths = []
+        self.n_samples = 0
+        self.epoch_start_time = time.perf_counter()
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        yield
+        self._sync()
+        self.times[name].append(time.perf_counter() - start)
+
+    def batches(self, loader):
+        ''' Iterates over a loader timing the wait for each batch.
+        '''
+        loader_iter = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.times['data'].append(time.perf_counter() - start)
+                depth = queue_depth(loader, loader_iter)
+                if depth is not None:
+                    self.queue_depths.append(depth)
+            yield batch
+
+    def start_step(self, global_step):
+        ''' Starts the torch.profiler trace at the first selected step.
+        '''
+        if self.trace_steps is not None and global_step == self.trace_steps[0] and self._torch_profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._torch_profiler.__enter__()
+
+    def end_step(self, global_step, n_samples):
+        ''' Counts the samples of a step, and saves the torch.profiler trace
+            after the last selected step.
+        '''
+        self.n_samples += n_samples
+
+        if self._torch_profiler is None:
+            return
+        first_step, n_steps = self.trace_steps
+        if global_step >= first_step + n_steps - 1:
+            self._torch_profiler.__exit__(None, None, None)
+            self._torch_profiler.export_chrome_trace(self.trace_file)
+            print('')
+            print('Saved profiler trace of steps {}-{} to {}'.format(first_step, global_step, self.trace_file))
+            self._torch_profiler = None
+            self.trace_steps = None
+
+    def summary(self, epoch):
+        ''' Per section step times (ms) for the epoch, with the share of the
+            step time each took.
+        '''
+        epoch_time = time.perf_counter() - self.epoch_start_time
+        total_time = sum(np.sum(times) for times in self.times.values())
+
+        sections = {}
+        for name, times in self.times.items():
+            times_ms = np.array(times) * 1000.0
+            sections[name] = {
+                'mean_ms': float(times_ms.mean()),
+                'p50_ms': float(np.percentile(times_ms, 50)),
+                'p90_ms': float(np.percentile(times_ms, 90)),
+                'max_ms': float(times_ms.max()),
+                'total_s': float(times_ms.sum() / 1000.0),
+                'fraction': float(np.sum(times) / max(total_time, 1e-9)),
+            }
+
+        return {
+            'epoch': epoch,
+            'n_steps': len(self.times['data']),
+            'n_samples': self.n_samples,
+            'epoch_time_s': epoch_time,
+            'samples_per_s': self.n_samples / max(epoch_time, 1e-9),
+            'mean_queue_depth': float(np.mean(self.queue_depths)) if self.queue_depths else None,
+            'min_queue_depth': int(np.min(self.queue_depths)) if self.queue_depths else None,
+            'sections': sections,
+        }
+
+    def end_epoch(self, epoch, write=True):
+        ''' Appends the epoch summary to the log file and starts a new epoch.
+        '''
+        if self.enabled and write and self.log_file is not None:
+            summary = self.summary(epoch)
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+
+            data_fraction = summary['sections'].get('data', {}).get('fraction', 0.0)
+            print('')
+            print('[Epoch {}] {:.1f} samples/sec, {:.0f}% of step time waiting for data'.format(
+                epoch, summary['samples_per_s'], 100 * data_fraction))
+        self.reset()
@@ -0,0 +1,73 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tactile_gym_sim2real.pix2pix.image_generator import collate_batch
+
+
+class ThreadedDataLoader():
+    ''' Drop in replacement for torch DataLoader over a map style DataGenerator
+        that builds batches on a pool of threads in the training process.
+        The cv2 decoding and preprocessing release the gil, so threads keep
+        up with worker processes without forking, pickling the dataset or
+        sending batches between processes.
+
+        At most n_threads * prefetch batches are in flight, batches are
+        returned in sampling order. A sampler, e.g. a DistributedSampler,
+        replaces the shuffled or sequential order.
+    '''
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, n_threads=4, prefetch=2,
+                 drop_last=False, collate_fn=collate_batch, sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_threads = n_threads
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.collate_fn = collate_fn
+        self.sampler = sampler
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._in_flight = deque()
+
+    def __len__(self):
+        n_samples = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        if self.drop_last:
+            return n_samples // self.batch_size
+        return -(-n_samples // self.batch_size)
+
+    def batch_indices(self):
+        if self.sampler is not None:
+            order = np.array(list(self.sampler), dtype=np.int64)
+        elif self.shuffle:
+            order = np.random.permutation(len(self.dataset))
+        else:
+            order = np.arange(len(self.dataset))
+        for i in range(len(self)):
+            yield order[i*self.batch_size:(i+1)*self.batch_size].tolist()
+
+    def load_batch(self, indices):
+        return self.collate_fn(self.dataset.__getitems__(indices))
+
+    def ready_batches(self):
+        ''' Number of prefetched batches ready to be returned.
+        '''
+        return sum(future.done() for future in list(self._in_flight))
+
+    def __iter__(self):
+        in_flight = self._in_flight = deque()
+        try:
+            for indices in self.batch_indices():
+                if len(in_flight) >= self.n_threads * self.prefetch:
+                    yield in_flight.popleft().result()
+                in_flight.append(self._pool.submit(self.load_batch, indices))
+
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # drop batches not yet started when iteration stops early
+            for future in in_flight:
+                future.cancel()
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,104 @@
+import contextlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_window(window_size=11, sigma=1.5):
+    coords = torch.arange(window_size, dtype=torch.float32) - window_size // 2
+    gauss = torch.exp(-coords**2 / (2 * sigma**2))
+    gauss = gauss / gauss.sum()
+    return torch.outer(gauss, gauss)[None, None]
+
+
+def ssim(images, targets, window_size=11, sigma=1.5):
+    ''' Mean structural similarity of each (C,H,W) image in a batch to its
+        target, with a gaussian window and each target's value range as the
+        data range, so it holds for normalised and standardised images.
+    '''
+    images, targets = images.float(), targets.float()
+    n_channels = images.size(1)
+    window = gaussian_window(window_size, sigma).to(images.device).expand(n_channels, 1, -1, -1)
+
+    data_range = (targets.amax(dim=(1, 2, 3)) - targets.amin(dim=(1, 2, 3))).clamp(min=1e-6)
+    c1 = ((0.01 * data_range)**2)[:, None, None, None]
+    c2 = ((0.03 * data_range)**2)[:, None, None, None]
+
+    def filt(x):
+        return F.conv2d(x, window, groups=n_channels)
+
+    mu_x, mu_y = filt(images), filt(targets)
+    sigma_xx = filt(images * images) - mu_x**2
+    sigma_yy = filt(targets * targets) - mu_y**2
+    sigma_xy = filt(images * targets) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x**2 + mu_y**2 + c1) * (sigma_xx + sigma_yy + c2))
+    return ssim_map.mean(dim=(1, 2, 3))
+
+
+def is_best_epoch(loss_df, row_id, column='Val_L1'):
+    ''' Whether a row of the loss history has the lowest validation loss so
+        far. Rows resumed from histories saved without validation metrics
+        are NaN and skipped.
+    '''
+    return loss_df.loc[row_id, column] <= loss_df[column].min()
+
+
+class Validator():
+    ''' Validation set for pix2pix training.
+
+        The first validation batch is kept in memory as it comes from the
+        loader (uint8 with --uint8_data) and used for every sample grid, the
+        validation data has no random augmentations so grids from different
+        epochs compare the same images. Metrics passes stream the whole
+        loader, so the validation set is never held in memory at once.
+
+        Sample grids and metrics use the generator in eval mode, as at
+        inference in gan_net.py.
+    '''
+
+    def __init__(self, val_loader, model_input, autocast=contextlib.nullcontext):
+        self.val_loader = val_loader
+        self.model_input = model_input
+        self.autocast = autocast
+        self._sample_batch = None
+
+    def sample_batch(self):
+        ''' The same validation batch every time, for comparable sample grids.
+        '''
+        if self._sample_batch is None:
+            self._sample_batch = next(iter(self.val_loader))
+        return self._sample_batch
+
+    @contextlib.contextmanager
+    def eval_mode(self, generator):
+        was_training = generator.training
+        generator.eval()
+        try:
+            with torch.no_grad(), self.autocast():
+                yield
+        finally:
+            generator.train(was_training)
+
+    def generate(self, generator, batch):
+        ''' Model inputs and generated images for a batch from the loader.
+        '''
+        real_images = self.model_input(batch['real'], 'real')
+        sim_images = self.model_input(batch['sim'], 'sim')
+        with self.eval_mode(generator):
+            gen_sim_images = generator(real_images).float()
+        return real_images, sim_images, gen_sim_images
+
+    def evaluate(self, generator):
+        ''' L1 and SSIM of the generated images to the sim images over the
+            whole validation set.
+        '''
+        l1_sum, ssim_sum, n_images = 0.0, 0.0, 0
+        for batch in self.val_loader:
+            _, sim_images, gen_sim_images = self.generate(generator, batch)
+            l1_sum += F.l1_loss(gen_sim_images, sim_images, reduction='none').mean(dim=(1, 2, 3)).sum().item()
+            ssim_sum += ssim(gen_sim_images, sim_images).sum().item()
+            n_images += sim_images.size(0)
+
+        n_images = max(n_images, 1)
+        return np.array([l1_sum / n_images, ssim_sum / n_images])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import cv2
+
+from tactile_gym_sim2real.image_transforms import process_image
+
+
+def deterministic_prefix(params, real=True):
+    ''' The leading process_image params that do not depend on the random
+        augmentations. Thresholding only belongs to the prefix when it is not
+        preceded by a random shift/zoom, i.e. with no shift/zoom or with
+        joint_aug, where shift/zoom is applied after processing.
+    '''
+    if not real:
+        return {'gray': True}
+
+    prefix = {
+        'gray': True,
+        'bbox': list(params['bbox']) if params.get('bbox') is not None else None,
+        'dims': list(params['dims']) if params.get('dims') is not None else None,
+        'fused': bool(params.get('fused', False)),
+        'thresh': False,
+    }
+
+    no_random_affine = params.get('rshift') is None and params.get('rzoom') is None
+    if params.get('thresh') and (no_random_affine or params.get('joint_aug', False)):
+        prefix['thresh'] = True
+
+    return prefix
+
+
+class PreprocessCache():
+    ''' On disk cache of the deterministic preprocessing prefix of raw images.
+
+        Entries are .npy files keyed by a hash of the source file's path,
+        size and modification time and the prefix params, so a hit costs a
+        stat rather than reading the image. Editing an image or changing the
+        params gives a new key and the stale entry is simply never read
+        again, moving the data dir starts a new set of entries. Writes go
+        through a temporary file and a rename, so concurrent DataLoader
+        workers and loader threads can share a cache dir.
+    '''
+
+    def __init__(self, cache_dir, prefix):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self._params_key = json.dumps(prefix, sort_keys=True).encode()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, filename):
+        stat = os.stat(filename)
+        file_key = '{}\0{}\0{}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns).encode()
+        return hashlib.sha1(file_key + self._params_key).hexdigest()
+
+    def __call__(self, filename):
+        ''' Returns the preprocessed (H,W,1) image for a raw image file.
+        '''
+        key = self.key(filename)
+        cache_file = os.path.join(self.cache_dir, key[:2], key + '.npy')
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
+
+        raw_image = cv2.imread(filename)
+        image = np.ascontiguousarray(process_image(raw_image, **self.prefix))
+
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{}.{}.{}.tmp.npy'.format(cache_file[:-4], os.getpid(), threading.get_ident())
+        np.save(tmp_file, image)
+        os.replace(tmp_file, cache_file)
+
+        return image
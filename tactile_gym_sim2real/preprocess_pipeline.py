@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import cv2
+import torch
+
+from tactile_gym_sim2real.image_transforms import load_json_obj, crop_resize_maps, fused_supersample, \
+    threshold_block_size, threshold_offset
+
+
+class PreprocessPipeline():
+    ''' Deterministic part of process_image (gray, bbox, dims, thresh, stdiz,
+        normlz) compiled once from a set of augmentation params into a fixed
+        chain of stages that write into preallocated buffers.
+
+        Calling the pipeline returns the (H,W,1) output buffer, the same
+        memory is exposed as a (1,1,H,W) torch tensor through self.tensor.
+        Both are overwritten by the next call, copy them if they need to be
+        kept. Random augmentations are not part of the pipeline.
+    '''
+
+    def __init__(self, params, bbox=None):
+
+        self.bbox = bbox if bbox is not None else params.get('bbox', None)
+        self.dims = tuple(params['dims']) if params.get('dims', None) is not None else None
+        self.thresh = bool(params.get('thresh', False))
+        self.stdiz = params.get('stdiz', False)
+        self.stdiz_stats = (params.get('stdiz_stats') or {}).get('real')
+        self.normlz = bool(params.get('normlz', False))
+        self.fused = bool(params.get('fused', False)) and self.dims is not None
+
+        self._input_shape = None
+        self._stages = []
+        self.output = None
+        self.tensor = None
+
+    @classmethod
+    def from_model_dir(cls, model_dir, bbox=None):
+        ''' Build a pipeline from the augmentation_params.json saved with a model.
+        '''
+        params = load_json_obj(os.path.join(model_dir, 'augmentation_params'))
+        return cls(params, bbox=bbox)
+
+    def __call__(self, image):
+        if image.shape != self._input_shape:
+            self._compile(image.shape)
+
+        src = image
+        for stage in self._stages:
+            src = stage(src)
+
+        return self.output
+
+    def _compile(self, input_shape):
+        ''' Allocate the buffers for a given raw image shape and bind the stages.
+        '''
+        h, w = input_shape[:2]
+        if self.bbox is not None:
+            x0, y0, x1, y1 = self.bbox
+            h, w = y1 - y0, x1 - x0
+
+        stages = []
+
+        if self.fused:
+            # Crop, gray scale and resize in one pass with precomputed remap tables
+            bbox = tuple(self.bbox) if self.bbox is not None else (0, 0, w, h)
+            supersample = fused_supersample(bbox, self.dims)
+            map_1, map_2 = crop_resize_maps(bbox, self.dims, supersample)
+            h, w = self.dims[1], self.dims[0]
+
+            sample_buf = np.empty((h * supersample, w * supersample, 3), dtype=np.uint8)
+            stages.append(lambda src: cv2.remap(src, map_1, map_2, cv2.INTER_LINEAR, dst=sample_buf))
+
+            if supersample > 1:
+                area_buf = np.empty((h, w, 3), dtype=np.uint8)
+                stages.append(lambda src: cv2.resize(src, self.dims, dst=area_buf, interpolation=cv2.INTER_AREA))
+
+            resize_buf = np.empty((h, w), dtype=np.uint8)
+            stages.append(lambda src: cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=resize_buf))
+
+        else:
+            if self.bbox is not None:
+                # Crop to specified bounding box, returns a view
+                stages.append(lambda src: src[y0:y1, x0:x1])
+
+            # Convert to gray scale, after the crop as this works per pixel
+            gray_buf = np.empty((h, w), dtype=np.uint8)
+            stages.append(lambda src: cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=gray_buf))
+
+            if self.dims is not None:
+                # Resize to specified dims
+                h, w = self.dims[1], self.dims[0]
+                resize_buf = np.empty((h, w), dtype=np.uint8)
+                stages.append(lambda src: cv2.resize(src, self.dims, dst=resize_buf, interpolation=cv2.INTER_AREA))
+
+        if self.thresh:
+            # Use adaptive thresholding to create binary image
+            thresh_buf = np.empty((h, w), dtype=np.uint8)
+            stages.append(lambda src: cv2.adaptiveThreshold(src, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                                              threshold_block_size, threshold_offset, dst=thresh_buf))
+
+        if self.stdiz or self.normlz:
+            # Convert to float
+            float_buf = np.empty((h, w), dtype=np.float32)
+            def to_float(src):
+                np.copyto(float_buf, src)
+                return float_buf
+            stages.append(to_float)
+
+        if self.stdiz == 'dataset':
+            # Standardise with the dataset constants saved with the model, in place
+            if self.stdiz_stats is None:
+                raise ValueError("stdiz='dataset' needs the real image stats in params['stdiz_stats']")
+            mean, scale = np.float32(self.stdiz_stats['mean']), np.float32(1.0 / self.stdiz_stats['std'])
+            def standardise(src):
+                np.subtract(src, mean, out=src)
+                np.multiply(src, scale, out=src)
+                return src
+            stages.append(standardise)
+
+        elif self.stdiz:
+            # Standardise on a per frame basis, in place
+            sq_buf = np.empty((h, w), dtype=np.float32)
+            def standardise(src):
+                np.subtract(src, src.mean(), out=src)
+                np.multiply(src, src, out=sq_buf)
+                np.divide(src, np.sqrt(sq_buf.mean()), out=src)
+                return src
+            stages.append(standardise)
+
+        if self.normlz:
+            # Normalise to 0-1, in place
+            stages.append(lambda src: np.divide(src, np.float32(255.0), out=src))
+
+        # the output is whichever buffer the final stage writes into
+        last_buf = float_buf if (self.stdiz or self.normlz) else \
+                   thresh_buf if self.thresh else \
+                   resize_buf if self.dims is not None else gray_buf
+
+        self._stages = stages
+        self._input_shape = input_shape
+        self.output = last_buf[..., np.newaxis]
+        self.tensor = torch.from_numpy(last_buf).view(1, 1, h, w)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+
+def _aligned(n_bytes, alignment=64):
+    return -(-n_bytes // alignment) * alignment
+
+
+class SharedImageCache():
+    ''' Fixed size cache of uint8 image stacks in a shared memory arena, read
+        and filled by every DataLoader worker, with least recently used
+        eviction once all slots are taken.
+
+        A single shared block holds the cache state and the arena:
+            index_to_slot   slot holding each item, -1 if not cached
+            slot_owner      item held by each slot, -1 if free
+            slot_stamp      last access time of each slot, for LRU eviction
+            counters        access clock, slots used, hits and misses
+            arena           (n_slots, *slot_shape) uint8 images
+        All access goes through one lock, copies in and out are small
+        compared with decoding an image.
+
+        Create it in the main process before the loader workers start, the
+        block is unlinked when the creating process closes it.
+    '''
+
+    def __init__(self, n_items, slot_shape, n_slots):
+        self.n_items = int(n_items)
+        self.slot_shape = tuple(slot_shape)
+        self.n_slots = int(min(n_slots, n_items))
+
+        size = sum(self._layout())
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._owner_pid = os.getpid()
+        self._lock = mp.Lock()
+        self._attach()
+
+        self.index_to_slot[:] = -1
+        self.slot_owner[:] = -1
+        self.slot_stamp[:] = 0
+        self.counters[:] = 0
+
+    @classmethod
+    def from_megabytes(cls, n_items, slot_shape, megabytes):
+        ''' Cache with as many slots as fit in the given arena size.
+        '''
+        slot_bytes = int(np.prod(slot_shape))
+        return cls(n_items, slot_shape, max(1, int(megabytes * 2**20) // slot_bytes))
+
+    def _layout(self):
+        return [
+            _aligned(self.n_items * 4),
+            _aligned(self.n_slots * 4),
+            _aligned(self.n_slots * 8),
+            _aligned(4 * 8),
+            self.n_slots * int(np.prod(self.slot_shape)),
+        ]
+
+    def _attach(self):
+        ''' Numpy views of the shared block.
+        '''
+        offsets = np.concatenate([[0], np.cumsum(self._layout())])
+        buf = self._shm.buf
+
+        def view(i, dtype, shape):
+            return np.ndarray(shape, dtype=dtype, buffer=buf, offset=int(offsets[i]))
+
+        self.index_to_slot = view(0, np.int32, (self.n_items,))
+        self.slot_owner = view(1, np.int32, (self.n_slots,))
+        self.slot_stamp = view(2, np.int64, (self.n_slots,))
+        self.counters = view(3, np.int64, (4,))
+        self.arena = view(4, np.uint8, (self.n_slots, *self.slot_shape))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_shm', 'index_to_slot', 'slot_owner', 'slot_stamp', 'counters', 'arena']:
+            del state[key]
+        state['_shm_name'] = self._shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('_shm_name')
+        self.__dict__.update(state)
+        # workers share the creating process's resource tracker, so attaching
+        # does not hand ownership of the block to the worker
+        self._shm = shared_memory.SharedMemory(name=shm_name)
+        self._attach()
+
+    def get(self, index):
+        ''' Returns a copy of the cached images for an item, or None.
+        '''
+        with self._lock:
+            slot = self.index_to_slot[index]
+            if slot < 0:
+                self.counters[3] += 1
+                return None
+
+            self.counters[0] += 1
+            self.counters[2] += 1
+            self.slot_stamp[slot] = self.counters[0]
+            return self.arena[slot].copy()
+
+    def put(self, index, images):
+        ''' Stores the images for an item, evicting the least recently used
+            item if the arena is full.
+        '''
+        with self._lock:
+            if self.index_to_slot[index] >= 0:
+                # already filled by another worker
+                return
+
+            if self.counters[1] < self.n_slots:
+                slot = self.counters[1]
+                self.counters[1] += 1
+            else:
+                slot = int(np.argmin(self.slot_stamp))
+                self.index_to_slot[self.slot_owner[slot]] = -1
+
+            self.arena[slot] = images
+            self.counters[0] += 1
+            self.slot_owner[slot] = index
+            self.slot_stamp[slot] = self.counters[0]
+            self.index_to_slot[index] = slot
+
+    def hit_rate(self):
+        hits, misses = self.counters[2], self.counters[3]
+        return hits / max(hits + misses, 1)
+
+    def close(self):
+        ''' Release this process's mapping, and the block itself if created here.
+        '''
+        if self._shm is None:
+            return
+        for key in ['index_to_slot', 'slot_owner', 'slot_stamp', 'counters', 'arena']:
+            setattr(self, key, None)
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+        self._shm = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
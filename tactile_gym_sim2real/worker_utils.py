@@ -0,0 +1,13 @@
+import os
+import cv2
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def init_worker():
+    # parallelism comes from the pool, avoid oversubscribing with cv2 threads
+    cv2.setNumThreads(1)
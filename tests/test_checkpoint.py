@@ -0,0 +1,31 @@
+import pandas as pd
+import torch
+
+from tactile_gym_sim2real.pix2pix.checkpoint import save_training_state, load_training_state
+from tactile_gym_sim2real.pix2pix.validation import is_best_epoch
+
+
+def test_resume_history_without_val_metrics_saves_best_models(tmp_path):
+    generator, discriminator = torch.nn.Linear(2, 2), torch.nn.Linear(2, 1)
+    optimizer_G = torch.optim.Adam(generator.parameters())
+    optimizer_D = torch.optim.Adam(discriminator.parameters())
+
+    # a history saved before validation metrics were tracked
+    saved_loss_df = pd.DataFrame({'Epoch': [1, 2], 'G_Loss': [0.9, 0.8]})
+    save_training_state(str(tmp_path), generator, discriminator, optimizer_G, optimizer_D,
+                        2, 10, saved_loss_df, {'row_id': 2})
+
+    # resumed as in pix2pix.py
+    _, _, loss_df, tracking = load_training_state(str(tmp_path), generator, discriminator,
+                                                  optimizer_G, optimizer_D)
+    loss_df = loss_df.reindex(columns=['Epoch', 'G_Loss', 'Val_L1', 'Val_SSIM'])
+    assert loss_df['Val_L1'].isna().all()
+
+    best = []
+    for epoch, val_l1 in zip([3, 4, 5], [0.5, 0.6, 0.4]):
+        row_id = tracking['row_id']
+        loss_df.loc[row_id] = [epoch, 0.7, val_l1, 0.9]
+        best.append(bool(is_best_epoch(loss_df, row_id)))
+        tracking['row_id'] += 1
+
+    assert best == [True, False, True]